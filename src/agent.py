@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+A device agent, rings alarms for a coordinator bot that runs elsewhere
+
+The agent only needs crontab and alarm.py, the coordinator runs the telegram bot, database and webserver.
+
+Protocol: json lines over TCP. On connect the agent sends {"device": name, "challenge": hex}. Every message
+after that is {"seq": n, "body": json string, "mac": hex}, where mac is an HMAC-SHA256 with the shared secret
+of the challenge, the direction, seq and body. The coordinator sends a batch of commands in body and the agent
+answers with the result of each command under the same seq. Messages are signed, not encrypted.
+
+Commands, every one is safe to replay:
+    {"op": "add", "alarm": alarm}          create or update an alarm, in the alarm_sets export format
+    {"op": "enable" | "disable" | "remove", "id": alarm id}
+    {"op": "stop", "stopped_by": name}     stop ringing alarms
+    {"op": "list"}                         get all alarms in the export format
+    {"op": "ping"}
+
+Sounds uploaded to the bot are not sent to the devices, alarms with a library sound are rejected.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import hashlib
+import threading
+import traceback
+import socketserver
+from common import get_config, LIBRARY_PREFIX
+from cron_jobs import CronJobs
+from alarm_sets import export_alarms, to_spec, AlarmSetError
+from alarm_watcher import stop_alarms
+
+DEFAULT_PORT = 7010
+
+# Commands that change alarms, a batch of them is written to crontab once
+ALARM_COMMANDS = ["add", "enable", "disable", "remove"]
+
+# Seconds between checks for DST transitions of alarms in other timezones
+SYNC_INTERVAL = 60
+
+# Longest line a peer may send, a batch of a few hundred alarms fits
+MAX_LINE = 1024 * 1024
+
+# Seconds a new connection has to send its first signed message, an authenticated one may stay idle
+AUTH_TIMEOUT = 10
+
+# The agent and the coordinator refuse to start with these, the example config ships change_me
+WEAK_SECRETS = ["", "change_me"]
+
+TO_AGENT = "to-agent"
+TO_COORDINATOR = "to-coordinator"
+
+
+class ProtocolError(Exception):
+    def __init__(self, message=""):
+        self.message = message
+
+
+def weak_secret(secret):
+    return secret is None or secret.strip() in WEAK_SECRETS
+
+
+def sign(secret, challenge, direction, seq, body):
+    message = "\n".join([challenge, direction, str(seq), body]).encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def write_message(f, secret, challenge, direction, seq, payload):
+    body = json.dumps(payload)
+    line = json.dumps({"seq": seq, "body": body, "mac": sign(secret, challenge, direction, seq, body)})
+    f.write(line.encode() + b"\n")
+    f.flush()
+    return
+
+
+def read_line(f):
+    """
+    :return: The next json line, None if the connection was closed
+    """
+    line = f.readline(MAX_LINE + 1)
+    if not line:
+        return None
+    if len(line) > MAX_LINE or not line.endswith(b"\n"):
+        raise ProtocolError("Line too long or connection closed mid line")
+    try:
+        return json.loads(line.decode())
+    except ValueError:
+        raise ProtocolError("Not json")
+
+
+def read_message(f, secret, challenge, direction, seq):
+    """
+    Read a signed message and check it is the expected one
+
+    :return: The payload, None if the connection was closed
+    """
+    message = read_line(f)
+    if message is None:
+        return None
+    try:
+        body = message["body"]
+        valid = message["seq"] == seq and hmac.compare_digest(
+            str(message["mac"]), sign(secret, challenge, direction, seq, body))
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise ProtocolError("Bad signature or sequence")
+    return json.loads(body)
+
+
+class Agent:
+    def __init__(self, name, secret, crontab):
+        """
+        :param name: Device name reported to the coordinator
+        :param secret: Secret shared with the coordinator
+        :param crontab: The CronJobs alarms are written to
+        """
+        self.name = name
+        self.secret = secret
+        self.crontab = crontab
+        # Batches from several connections must not interleave their read and write of crontab
+        self.lock = threading.Lock()
+
+    def apply_alarm_command(self, command, alarms, specs, removed):
+        """
+        Apply one alarm command to the alarms of the device as exported
+
+        :param specs: Import specs of the alarms changed so far, by id
+        :param removed: Ids of the alarms removed so far
+        :return: The result of the command
+        :raises AlarmSetError: if the command would make an invalid alarm, nothing is changed then
+        """
+        if command["op"] == "add":
+            alarm = command.get("alarm")
+            spec = to_spec(alarm)
+            if str(alarm.get("sound")).startswith(LIBRARY_PREFIX):
+                raise AlarmSetError("Alarm " + spec["id"] + " has a library sound, they are not on this device")
+        else:
+            alarm_id = command.get("id")
+            if not isinstance(alarm_id, str) or alarm_id not in alarms:
+                # Already applied by an earlier delivery of the same command
+                return {"ok": True, "missing": True}
+            if command["op"] == "remove":
+                del alarms[alarm_id]
+                specs.pop(alarm_id, None)
+                removed.add(alarm_id)
+                return {"ok": True}
+            alarm = dict(alarms[alarm_id], enabled=command["op"] == "enable")
+            spec = to_spec(alarm)
+
+        alarms[spec["id"]] = alarm
+        specs[spec["id"]] = spec
+        removed.discard(spec["id"])
+        return {"ok": True}
+
+    def apply_alarm_commands(self, commands):
+        """
+        Apply alarm commands to the alarms of the device, with a single crontab write
+
+        :return: A result for every command, a command that is not valid gets its error and the others still apply
+        """
+        results = []
+        alarms = {alarm["id"]: alarm for alarm in export_alarms(self.crontab)["alarms"]}
+        specs = {}
+        removed = set()
+        for command in commands:
+            try:
+                results.append(self.apply_alarm_command(command, alarms, specs, removed))
+            except AlarmSetError as e:
+                results.append({"ok": False, "error": e.message})
+
+        summary = self.crontab.import_jobs(list(specs.values()), remove=removed)
+        print("Applied " + str(len(commands)) + " commands: " +
+              ", ".join(key + " " + str(len(summary[key])) for key in ["added", "updated", "removed"]))
+        return results
+
+    def handle(self, commands):
+        """
+        Run a batch of commands, in order
+
+        :return: A list with the result of every command
+        """
+        results = []
+        with self.lock:
+            i = 0
+            while i < len(commands):
+                command = commands[i]
+                op = command.get("op") if isinstance(command, dict) else None
+                if op in ALARM_COMMANDS:
+                    # Group consecutive alarm commands into one crontab write
+                    end = i
+                    while end < len(commands) and isinstance(commands[end], dict) \
+                            and commands[end].get("op") in ALARM_COMMANDS:
+                        end += 1
+                    results += self.apply_alarm_commands(commands[i:end])
+                    i = end
+                    continue
+
+                if op == "stop":
+                    results.append({"ok": True, "stopped": stop_alarms(str(command.get("stopped_by", "")))})
+                elif op == "list":
+                    results.append({"ok": True, "alarms": export_alarms(self.crontab)["alarms"]})
+                elif op == "ping":
+                    results.append({"ok": True})
+                else:
+                    results.append({"ok": False, "error": "Unknown command: " + str(op)})
+                i += 1
+        return results
+
+    def serve_connection(self, f, sock=None):
+        """
+        :param f: File of the connection
+        :param sock: Socket of the connection, its timeout is lifted once the coordinator authenticated
+        """
+        challenge = os.urandom(16).hex()
+        f.write(json.dumps({"device": self.name, "challenge": challenge}).encode() + b"\n")
+        f.flush()
+        seq = 0
+        while True:
+            commands = read_message(f, self.secret, challenge, TO_AGENT, seq)
+            if commands is None:
+                return
+            if not isinstance(commands, list):
+                raise ProtocolError("Expected a list of commands")
+            if seq == 0 and sock is not None:
+                sock.settimeout(None)
+            write_message(f, self.secret, challenge, TO_COORDINATOR, seq, self.handle(commands))
+            seq += 1
+
+    def sync_timezones(self):
+        while True:
+            time.sleep(SYNC_INTERVAL)
+            try:
+                self.crontab.sync_timezones()
+            except Exception:
+                print(str(traceback.format_exc()))
+
+
+class AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            # Until the coordinator authenticates, so idle connections do not keep a thread each
+            self.request.settimeout(AUTH_TIMEOUT)
+            self.server.agent.serve_connection(self.request.makefile("rwb"), self.request)
+        except ProtocolError as e:
+            print("Dropping coordinator connection from " + self.client_address[0] + ": " + e.message)
+        except OSError as e:
+            print("Coordinator connection from " + self.client_address[0] + " failed: " + str(e))
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, agent):
+        self.agent = agent
+        socketserver.TCPServer.__init__(self, address, AgentHandler)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(add_help=True, description="Ring alarms sent by a coordinator bot")
+    parser.add_argument('--name', type=str, default=socket.gethostname(), help='Device name, defaults to the hostname')
+    parser.add_argument('--host', type=str, default="0.0.0.0", help='Address to listen on')
+    parser.add_argument('--port', type=int, default=None, help='Port to listen on, defaults to [fleet] agent_port')
+    parser.add_argument('--tab', type=str, default=None,
+                        help='Keep alarms in this crontab file instead of the user crontab, for testing')
+    args = parser.parse_args()
+
+    fleet_settings = get_config().get("fleet", {})
+    if weak_secret(fleet_settings.get("secret")):
+        print("Error, set a [fleet] secret of your own, the same on the coordinator and every device")
+        sys.exit(1)
+    port = args.port if args.port is not None else int(fleet_settings.get("agent_port", DEFAULT_PORT))
+    agent = Agent(args.name, fleet_settings["secret"].strip(), CronJobs("alarmbot", tabfile=args.tab))
+
+    sync_thread = threading.Thread(target=agent.sync_timezones)
+    sync_thread.daemon = True
+    sync_thread.start()
+
+    server = AgentServer((args.host, port), agent)
+    print("Agent " + args.name + " listening on " + args.host + ":" + str(port))
+    server.serve_forever()
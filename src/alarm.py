@@ -12,10 +12,27 @@ import signal
 import time
 import os
 import threading
+import queue
+import subprocess
+import mmap
+import struct
 import pyaudio
 from pydub import AudioSegment
 from pydub.utils import make_chunks
-from alarm_bot import ensure_dir
+from common import ensure_dir, get_config, get_uri, DEFAULT_SOUND, STREAM_FRAME_RATE, STREAM_CHANNELS, \
+    STREAM_SAMPLE_WIDTH, STREAM_BLOCK_SIZE
+from history import HistoryWriter
+
+# Files larger than this are decoded incrementally instead of all at once
+STREAM_THRESHOLD = 2 * 1024 * 1024
+
+# Number of decoded blocks buffered ahead of playback
+STREAM_BUFFER_BLOCKS = 40
+
+# Decoded audio up to this size is kept so looping does not decode again
+STREAM_CACHE_BUDGET = 32 * 1024 * 1024
+
+WAVE_FORMAT_PCM = 1
 
 
 def touch(fname, mode=0o666, dir_fd=None, **kwargs):
@@ -53,7 +70,7 @@ class PlayerLoop(threading.Thread):
     A simple class based on PyAudio and pydub to play in a loop in the backgound
     """
 
-    def __init__(self, filepath, loop=True):
+    def __init__(self, filepath, loop=True, volume=100.0):
         """
         Initialize `PlayerLoop` class.
 
@@ -61,10 +78,13 @@ class PlayerLoop(threading.Thread):
             -- filepath (String) : File Path to wave file.
             -- loop (boolean)    : True if you want loop playback.
                                    False otherwise.
+            -- volume (float)    : Volume in percent.
         """
         super(PlayerLoop, self).__init__()
         self.filepath = os.path.abspath(filepath)
         self.loop = loop
+        self.volume = volume
+        self.first_audio = None
 
     def run(self):
         # Open an audio segment
@@ -79,7 +99,7 @@ class PlayerLoop(threading.Thread):
         # PLAYBACK LOOP
         start = 0
         length = sound.duration_seconds
-        volume = 100.0
+        volume = self.volume
         playchunk = sound[start*1000.0:(start+length)*1000.0] - (60 - (60 * (volume/100.0)))
         millisecondchunk = 50 / 1000.0
 
@@ -88,6 +108,7 @@ class PlayerLoop(threading.Thread):
             for chunks in make_chunks(playchunk, millisecondchunk*1000):
                 self.time += millisecondchunk
                 stream.write(chunks._data)
+                self.mark_first_audio()
                 if not self.loop:
                     break
                 if self.time >= start+length:
@@ -96,6 +117,10 @@ class PlayerLoop(threading.Thread):
         stream.close()
         player.terminate()
 
+    def mark_first_audio(self):
+        if self.first_audio is None:
+            self.first_audio = time.time()
+
     def play(self) :
         """
         Just another name for self.start()
@@ -107,14 +132,240 @@ class PlayerLoop(threading.Thread):
         Stop playback.
         """
         self.loop = False
-    
-    
-def play_audio_background(audio_file):
+
+
+class StreamingPlayerLoop(PlayerLoop):
+    """
+    Play in a loop while decoding the file incrementally through a bounded buffer,
+    so playback starts after the first block and memory stays flat for long tracks
+    """
+
+    def __init__(self, filepath, loop=True, buffer_blocks=STREAM_BUFFER_BLOCKS, cache_budget=STREAM_CACHE_BUDGET,
+                 volume=100.0):
+        """
+        Initialize `StreamingPlayerLoop` class.
+
+        PARAM:
+            -- filepath (String)    : File Path to audio file.
+            -- loop (boolean)       : True if you want loop playback.
+                                      False otherwise.
+            -- volume (float)       : Volume in percent.
+            -- buffer_blocks (int)  : Number of decoded blocks to buffer ahead.
+            -- cache_budget (int)   : Max bytes of decoded audio kept for looping.
+        """
+        super(StreamingPlayerLoop, self).__init__(filepath, loop, volume)
+        self.buffer_blocks = buffer_blocks
+        self.cache_budget = cache_budget
+        self.cache = None
+        self.decoder = None
+
+    def decode_command(self):
+        volume = self.volume
+        command = [AudioSegment.converter, "-v", "quiet", "-nostdin", "-i", self.filepath,
+                   "-f", "s16le", "-acodec", "pcm_s16le",
+                   "-ac", str(STREAM_CHANNELS), "-ar", str(STREAM_FRAME_RATE)]
+        gain = -(60 - (60 * (volume/100.0)))
+        if gain != 0:
+            command += ["-af", "volume=" + str(gain) + "dB"]
+        return command + ["-"]
+
+    def decode(self, blocks):
+        """
+        Run the decoder once over the whole file and feed its output to blocks.
+        Fills self.cache when the decoded file fits in the cache budget.
+
+        :param blocks: A bounded queue the player reads from, None marks the end of the file
+        """
+        self.decoder = subprocess.Popen(self.decode_command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        cache = []
+        cache_size = 0
+        try:
+            while self.loop:
+                block = self.decoder.stdout.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    if cache is not None:
+                        self.cache = cache
+                    break
+                if cache is not None:
+                    cache_size += len(block)
+                    if cache_size <= self.cache_budget:
+                        cache.append(block)
+                    else:
+                        cache = None
+                self.put_block(blocks, block)
+        finally:
+            self.decoder.stdout.close()
+            if self.decoder.poll() is None:
+                self.decoder.kill()
+            self.decoder.wait()
+            self.put_block(blocks, None)
+
+    def put_block(self, blocks, block):
+        while self.loop:
+            try:
+                blocks.put(block, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def decoded_blocks(self):
+        """
+        Yield decoded blocks of one pass over the file, from the cache when possible
+        """
+        if self.cache is not None:
+            for block in self.cache:
+                yield block
+            return
+
+        blocks = queue.Queue(maxsize=self.buffer_blocks)
+        decoder = threading.Thread(target=self.decode, args=(blocks,))
+        decoder.daemon = True
+        decoder.start()
+        while self.loop:
+            try:
+                block = blocks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if block is None:
+                break
+            yield block
+        decoder.join()
+
+    def run(self):
+        player = pyaudio.PyAudio()
+
+        stream = player.open(format=player.get_format_from_width(STREAM_SAMPLE_WIDTH),
+                             channels=STREAM_CHANNELS,
+                             rate=STREAM_FRAME_RATE,
+                             output=True)
+
+        # PLAYBACK LOOP
+        while self.loop:
+            played = False
+            for block in self.decoded_blocks():
+                played = True
+                stream.write(block)
+                self.mark_first_audio()
+                if not self.loop:
+                    break
+            if not played:
+                # Nothing could be decoded, avoid spinning on a broken file
+                break
+
+        stream.close()
+        player.terminate()
+
+
+def find_pcm_data(f):
+    """
+    Find the sample data of a PCM wav file
+
+    :param f: A wav file opened in binary mode
+    :return: (offset, length, channels, frame_rate, sample_width) or None if it is not a PCM wav
+    """
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        return None
+
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", f.read(16))
+            f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if fmt is None or fmt[0] != WAVE_FORMAT_PCM:
+                return None
+            audio_format, channels, frame_rate, _, _, bits_per_sample = fmt
+            return f.tell(), chunk_size, channels, frame_rate, bits_per_sample // 8
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+class MappedPlayerLoop(PlayerLoop):
+    """
+    Play an already decoded PCM wav file in a loop straight from a memory map
+    """
+
+    def run(self):
+        with open(self.filepath, "rb") as f:
+            offset, length, channels, frame_rate, sample_width = find_pcm_data(f)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # pydub writes 0xFFFFFFFF as the data length when it streams the header
+        length = min(length, len(data) - offset)
+        frame_size = channels * sample_width
+        block_size = (frame_rate // 20) * frame_size
+
+        player = pyaudio.PyAudio()
+        stream = player.open(format=player.get_format_from_width(sample_width),
+                             channels=channels,
+                             rate=frame_rate,
+                             output=True)
+
+        # PLAYBACK LOOP
+        view = memoryview(data)
+        end = offset + length - (length % frame_size)
+        while self.loop and end > offset:
+            for position in range(offset, end, block_size):
+                stream.write(bytes(view[position:min(position + block_size, end)]))
+                self.mark_first_audio()
+                if not self.loop:
+                    break
+
+        view.release()
+        data.close()
+        stream.close()
+        player.terminate()
+
+
+def is_pcm_wav(audio_file):
+    try:
+        with open(audio_file, "rb") as f:
+            return find_pcm_data(f) is not None
+    except (OSError, struct.error):
+        return False
+
+
+def should_stream(audio_file):
+    """
+    Decide if a file is large enough to be worth decoding incrementally
+
+    :param audio_file: Path to the audio file
+    :return: True if the file should be played with StreamingPlayerLoop
+    """
+    try:
+        return os.path.getsize(audio_file) > STREAM_THRESHOLD
+    except OSError:
+        return False
+
+
+def play_audio_background(audio_file, stream=None, volume=100.0):
     """
     Play audio file in the background, accept a SIGINT or SIGTERM to stop
+
+    :param audio_file: Path to the audio file
+    :param stream: True to decode incrementally, False to decode the whole file first, None to decide by file size
+    :param volume: Volume in percent
+    :return: The player that played the file
     """
     killer = GracefulKiller()
-    player = PlayerLoop(audio_file)
+    if not os.path.isfile(audio_file):
+        print("Audio file " + audio_file + " is missing, playing the default alarm")
+        audio_file = DEFAULT_SOUND
+    if stream is None:
+        stream = should_stream(audio_file)
+
+    # The memory mapped player plays samples as they are, the others can change the volume
+    if is_pcm_wav(audio_file) and volume == 100.0:
+        player = MappedPlayerLoop(audio_file)
+    elif stream or is_pcm_wav(audio_file):
+        player = StreamingPlayerLoop(audio_file, volume=volume)
+    else:
+        player = PlayerLoop(audio_file, volume=volume)
     player.play()
     while True:      
         time.sleep(0.5)
@@ -123,16 +374,114 @@ def play_audio_background(audio_file):
             break
     player.stop()
     print("End of the program. I was killed gracefully :)")
-    return
+    return player
+
+
+def play_shared(audio_file, overlap, volume=100.0):
+    """
+    Play audio file through the single owner of the audio device, accept a SIGINT or SIGTERM to stop
+
+    :param audio_file: Path to the audio file
+    :param overlap: Policy for alarms that ring at the same time, see audio_owner
+    :param volume: Volume in percent
+    :return: (the alarm, to wait() on once this alarm is recorded, timestamp it was first heard)
+    """
+    # Imported here, audio_owner imports this module
+    from audio_owner import start_alarm
+
+    killer = GracefulKiller()
+    if not os.path.isfile(audio_file):
+        print("Audio file " + audio_file + " is missing, playing the default alarm")
+        audio_file = DEFAULT_SOUND
+
+    alarm = start_alarm(audio_file, overlap, volume)
+    first_audio = None
+    while not killer.kill_now:
+        time.sleep(0.5)
+        first_audio = first_audio or alarm.first_audio
+        if not alarm.ringing():
+            if not alarm.remote:
+                break
+            # The owner went away while this alarm rings, take over
+            alarm = start_alarm(audio_file, overlap, volume)
+    alarm.stop()
+    return alarm, first_audio or alarm.first_audio
+
+
+def process_start_time():
+    """
+    Get when this process was started, so the history includes interpreter startup in the latency
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may have spaces, fields after it are space separated
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return time.time()
+
+
+def start_history_writer():
+    try:
+        uri = get_uri(get_config())
+    except KeyError:
+        print("No database in config, not recording alarm history")
+        return None
+    writer = HistoryWriter(uri)
+    writer.start()
+    return writer
+
+
+def read_stopped_by(lock_path):
+    """
+    The bot writes who stopped the alarm in the lock file before signaling
+    """
+    try:
+        with open(lock_path) as f:
+            return f.read().strip()[:64] or None
+    except OSError:
+        return None
 
 
-def play_with_pid_lock(audio_file):
+def play_with_pid_lock(audio_file, stream=None, alarm_id=None):
+    fired_at = process_start_time()
     lock_dir = os.path.expanduser(os.path.join("~", ".alarmbot"))
     ensure_dir(lock_dir)
     lock_path = os.path.join(lock_dir, str(os.getpid()) + ".lock")
     touch(lock_path)
-    play_audio_background(audio_file)
+    history = start_history_writer()
+
+    # Read here, so a changed volume applies from the next alarm
+    volume = get_config().get_float("alarm", "volume", 100.0)
+    overlap = get_config().get_value("alarm", "overlap")
+    shared = None
+    if stream is not None and overlap != "off":
+        print("--stream and --no-stream only apply with [alarm] overlap=off, the audio owner decides how to play")
+    if overlap == "off":
+        # Every alarm opens its own stream
+        first_audio = play_audio_background(audio_file, stream, volume).first_audio
+    else:
+        shared, first_audio = play_shared(audio_file, overlap, volume)
+    stopped_at = time.time()
+    stopped_by = read_stopped_by(lock_path)
     os.unlink(lock_path)
+
+    if history is not None:
+        # cron starts alarms at the start of the minute, measure from there
+        scheduled_at = fired_at - fired_at % 60 if alarm_id is not None else fired_at
+        latency_ms = None
+        if first_audio is not None:
+            latency_ms = int((first_audio - scheduled_at) * 1000)
+        history.record(alarm_id=alarm_id, pid=os.getpid(), sound=audio_file[-255:], fired_at=fired_at,
+                       first_audio_at=first_audio, stopped_at=stopped_at, stopped_by=stopped_by,
+                       latency_ms=latency_ms)
+        history.close()
+
+    if shared is not None:
+        # This process may own the audio device, and play alarms of others until they are stopped
+        shared.wait()
     return
 
 if __name__ == '__main__':
@@ -140,7 +489,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(add_help=True,
                                      description="Play a file continuously, and exit gracefully on signal")
     parser.add_argument('audio_file', type=str, help='The Path to the audio file (mp3, wav and more supported)')
+    stream_group = parser.add_mutually_exclusive_group()
+    stream_group.add_argument('--stream', dest='stream', action='store_true', default=None,
+                              help='Decode the file incrementally while playing (default for large files), '
+                                   'only with overlap=off')
+    stream_group.add_argument('--no-stream', dest='stream', action='store_false',
+                              help='Decode the whole file before playing, only with overlap=off')
+    parser.add_argument('--alarm-id', type=str, default=None, help='Id of the alarm, recorded in the history')
     args = parser.parse_args()
     
-    play_with_pid_lock(args.audio_file)
+    play_with_pid_lock(args.audio_file, args.stream, args.alarm_id)
 
@@ -15,51 +15,40 @@ from telegram import ReplyKeyboardMarkup
 from emoji import emojize
 import logging
 import traceback
-from crontab import CronTab
-import signal
-from configparser import ConfigParser
-from collections import OrderedDict
 import os
 import json
-import random
-import string
 import sys
 from functools import wraps
 from urllib.request import urlopen, URLError
 import time
+import threading
+from datetime import datetime
 import pytz
 import subprocess
-from database import TelegramUser
+from database import TelegramUser, AlarmEvent, create_tables
+from common import ALARM_COMMAND, DEFAULT_SOUND, get_config, on_config_change, reload_config
+from alarm_watcher import stop_alarms, stop_alarm, get_alarm_watcher, read_alarm_command
+import events
+from sound_library import SoundLibrary, SoundLibraryError
+from warmup import WarmupScheduler, DEFAULT_LEAD_SECONDS
+from snooze import SnoozeScheduler, snooze_minutes
+from cron_jobs import get_cron_jobs, register_cron_jobs, get_job_id, get_job_sound, get_job_info, short_description
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from functools import wraps, partial
+from functools import wraps, partial, lru_cache
 
 debug = 'DEBUG' in os.environ and os.environ['DEBUG'] == "on"
 
-ALARM_COMMAND = os.path.abspath(os.path.join(os.path.dirname(__file__), "alarm.py"))
-DIR = os.path.dirname(__file__)
+DEFAULT_SOUND_NAME = "Default"
 
+# Number of alarm events /history shows
+HISTORY_LENGTH = 10
 
-def ensure_dir(d):
-    if not os.path.exists(d):
-        os.makedirs(d)
+# How long a role read from the database is trusted, changes from the webserver invalidate it sooner
+ROLE_CACHE_SECONDS = 60
 
-
-def ini_to_dict(path):
-    """ Read an ini path in to a dict
-
-    :param path: Path to file
-    :return: an OrderedDict of that path ini data
-    """
-    config = ConfigParser()
-    config.read(path)
-    return_value=OrderedDict()
-    for section in reversed(config.sections()):
-        return_value[section]=OrderedDict()
-        section_tuples = config.items(section)
-        for itemTurple in reversed(section_tuples):
-            return_value[section][itemTurple[0]] = itemTurple[1]
-    return return_value
+# Seconds between checks if config.ini changed
+CONFIG_CHECK_SECONDS = 5
 
 
 def run_command(command, blocking=True):
@@ -70,6 +59,7 @@ def run_command(command, blocking=True):
     return
 
 
+@lru_cache(maxsize=1)
 def get_timezones():
     return_value = {}
     for tz in pytz.common_timezones:
@@ -86,36 +76,71 @@ def get_timezones():
     return return_value
 
 
-def short_description(job, use_24hour_time_format=True):
-    replace_list = [["Sunday", "Sun"],
-                    ["Monday", "Mon"],
-                    ["Tuesday", "Tue"],
-                    ["Wednesday", "Wed"],
-                    ["Thursday", "Thr"],
-                    ["Friday", "Fri"],
-                    ["Saturday", "Sat"],
-                    [" through ", "-"],
-                    ["At", ""]]
+class RoleCache:
+    """
+    Roles of telegram users, so restricted commands do not query the database every time
+    """
 
-    description = job.description(use_24hour_time_format=use_24hour_time_format)
-    for r in replace_list:
-        description = description.replace(r[0], r[1])
-    return description.strip()
+    def __init__(self, engine, ttl=ROLE_CACHE_SECONDS):
+        self.engine = engine
+        self.ttl = ttl
+        self.roles = {}
+        self.lock = threading.Lock()
+
+    def get(self, telegram_id):
+        """
+        :return: The role of the user, or None if the user is unknown
+        """
+        now = time.time()
+        with self.lock:
+            cached = self.roles.get(telegram_id)
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+
+        Session = sessionmaker()
+        Session.configure(bind=self.engine)
+        session = Session()
+        result = session.query(TelegramUser).filter(TelegramUser.id == telegram_id).first()
+        role = None if result is None else result.role
+        with self.lock:
+            self.roles[telegram_id] = (role, now)
+        return role
+
+    def invalidate(self, telegram_ids):
+        with self.lock:
+            for telegram_id in telegram_ids:
+                self.roles.pop(telegram_id, None)
+        return
 
+    def on_event(self, kind, data, version):
+        if kind == events.ROLE_CHANGED:
+            self.invalidate([change["user"] for change in data["changes"]])
+        elif kind == events.USER_JOINED:
+            self.invalidate([data["user"]])
+        return
 
-def get_id(existing_ids=[]):
-    new_id = ''.join(random.sample((string.ascii_uppercase+string.digits + string.ascii_lowercase),4))
-    if new_id in existing_ids:
-        return get_id(existing_ids)
-    return new_id
 
+def has_access(role_cache, telegram_id, roles):
+    return role_cache.get(telegram_id) in roles
 
-def has_access(engine, telegram_id, roles):
+def get_user_timezone(engine, telegram_id):
     Session = sessionmaker()
     Session.configure(bind=engine)
     session = Session()
     result = session.query(TelegramUser).filter(TelegramUser.id == telegram_id).first()
-    return result.role in roles
+    if result is None:
+        return None
+    return result.timezone
+
+
+def set_user_timezone(engine, telegram_id, timezone):
+    Session = sessionmaker()
+    Session.configure(bind=engine)
+    session = Session()
+    session.query(TelegramUser).filter(TelegramUser.id == telegram_id).update({"timezone": timezone})
+    session.commit()
+    return
+
 
 def has_user(engine, telegram_id):
     Session = sessionmaker()
@@ -136,7 +161,7 @@ def restricted(func=None, *, roles=["user", "admin"]):
         update = args[2]
 
         user_id = update.effective_user.id
-        if not has_access(self.engine, user_id, roles):
+        if not has_access(self.role_cache, user_id, roles):
             bot.send_message(chat_id=update.message.chat_id,
                              text="You have no permission to use this command, use web UI to give authorization.",
                              reply_to_message_id=update.message.message_id)
@@ -152,11 +177,6 @@ class TelegramCallbackError(Exception):
         self.message = message
 
 
-class CronJobsError(Exception):
-    def __init__(self, message = ""):
-        self.message = message
-
-
 def build_callback(data):
     return_value = json.dumps(data)
     if len(return_value) > 64:
@@ -164,78 +184,6 @@ def build_callback(data):
     return return_value
 
 
-class CronJobs:
-    def __init__(self, cron_id, user=True):
-        if " " in cron_id:
-            raise CronJobsError("Cron ID must not contain spaces")
-
-        self.cron_id = cron_id
-        self.user = user
-        self.cron = CronTab(user=user)
-
-    def _create_job(self, command):
-        return self.cron.new(command=command, comment=self.cron_id + " " + get_id(self.get_ids()))
-
-    def add_daily(self, command, hour, minute):
-        job = self._create_job(command)
-        job.hour.on(hour)
-        job.minute.on(minute)
-        job.enable()
-        self.cron.write()
-        return
-    
-    def add_weekday(self, command, hour, minute):
-        job = self._create_job(command)
-        job.dow.during("SUN", "THU")  # "FRI", "SAT"
-        job.hour.on(hour)
-        job.minute.on(minute)
-        job.enable()
-        self.cron.write()
-        return
-
-    def job_list(self):
-        return_value = []
-        for job in self.cron:
-            if job.comment.split(" ")[0] == self.cron_id:
-                return_value.append(job)
-        return_value.sort(key=lambda job: job.schedule().get_next(float))
-        return return_value
-
-    def get_readable_jobs(self):
-        return_value = []
-        for job in self.job_list():
-            return_value.append(short_description(job))
-        return return_value
-
-    def get_ids(self):
-        return_value = []
-        for job in self.job_list():
-            return_value.append(get_job_id(job))
-        return return_value
-
-    def disable(self, job):
-        job.enable(False)
-        self.cron.write()
-        return
-
-    def enable(self, job):
-        job.enable(True)
-        self.cron.write()
-        return
-
-    def remove(self, job):
-        self.cron.remove(job)
-        self.cron.write()
-
-
-def get_job_id(job):
-    try:
-        return job.comment.split(" ")[1]
-    except IndexError:
-        print(str(traceback.format_exc()))
-        return None
-
-
 def handle_cancel(update):
     query = update.message.text
     if query == "Close" or query == "/cancel":
@@ -252,24 +200,52 @@ def insert_new_user_to_db(engine, telegram_id, name, role="guest"):
     entry = TelegramUser(id=telegram_id, name=name, role=role)
     session.add(entry)
     session.commit()
+    events.publish(events.USER_JOINED, user=telegram_id, name=name, role=role)
     return
 
 class Bot:
     def __init__(self, token, settings):
 
         self.engine = create_engine(get_uri(settings))
-
-        self.crontab = CronJobs("alarmbot")
+        self.role_cache = RoleCache(self.engine)
+        events.subscribe(self.role_cache.on_event)
+
+        fleet_settings = settings.get("fleet", {})
+        self.fleet = None
+        if fleet_settings.get("mode", "off") == "coordinator":
+            # Alarms ring on the fleet devices, only the agent parts run there
+            from fleet import Fleet, FleetCronJobs, TABFILE
+            self.fleet = Fleet(fleet_settings)
+            self.crontab = FleetCronJobs("alarmbot", self.fleet, fleet_settings.get("tabfile", TABFILE))
+            register_cron_jobs(self.crontab)
+        else:
+            self.crontab = get_cron_jobs("alarmbot")
+        self.sounds = SoundLibrary(self.engine, settings)
         self.selected_alarm_type = ""
+        self.selected_hour = 0
+        self.selected_minute = 0
         self.selected_continent = ""
-        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                            level=settings.get_value("main", "log_level", "INFO").upper())
 
         self.updater = Updater(token=token)
         self.dispatcher = self.updater.dispatcher
+
+        warmup_settings = settings.get("warmup", {})
+        self.warmup = None
+        if warmup_settings.get("enabled", "on") == "on" and self.fleet is None:
+            self.warmup = WarmupScheduler(self.crontab, self.updater.job_queue, get_job_sound,
+                                          int(warmup_settings.get("lead_seconds", DEFAULT_LEAD_SECONDS)))
+
+        # Ringing messages with a snooze button, alarms of a fleet ring on the devices instead
+        self.snoozes = None
+        self.ringing_messages = {}
+        if self.fleet is None:
+            self.snoozes = SnoozeScheduler(self.updater.job_queue, self.fire_alarm)
         start_handler = CommandHandler('start', self.start)
         self.dispatcher.add_handler(start_handler)
 
-        self.ALARM_TYPE, self.ALARM_HOUR = range(2)
+        self.ALARM_TYPE, self.ALARM_HOUR, self.ALARM_SOUND = range(3)
 
         self.TIMEZONE_CONTINENT, self.TIMEZONE_TIME = range(2)
 
@@ -279,7 +255,9 @@ class Bot:
             states={
                 self.ALARM_TYPE: [RegexHandler('^(Daily|Weekday Only|Close|/cancel)$', self.alarm_type)],
 
-                self.ALARM_HOUR: [RegexHandler('^([0-2][0-9]:[0-5][0-9]|[0-9]:[0-5][0-9]|/cancel)$', self.hour)]
+                self.ALARM_HOUR: [RegexHandler('^([0-2][0-9]:[0-5][0-9]|[0-9]:[0-5][0-9]|/cancel)$', self.hour)],
+
+                self.ALARM_SOUND: [MessageHandler(Filters.text, self.alarm_sound)]
             },
             fallbacks=[CommandHandler('cancel', self.cancel)]
         )
@@ -289,7 +267,7 @@ class Bot:
         set_timezone_handler = ConversationHandler(
             entry_points=[CommandHandler('timezone', self.set_timezone)],
             states={
-                self.TIMEZONE_CONTINENT: [RegexHandler('^(' + "|".join(get_timezones().keys()) + '|/cancel)$', self.timezone_continent)],
+                self.TIMEZONE_CONTINENT: [RegexHandler('^([A-Za-z_]+|/cancel)$', self.timezone_continent)],
 
                 self.TIMEZONE_TIME: [RegexHandler('^(.*)$', self.timezone_time)]
             },
@@ -312,6 +290,18 @@ class Bot:
         test_handler = CommandHandler('test', self.test)
         self.dispatcher.add_handler(test_handler)
 
+        history_handler = CommandHandler('history', self.history)
+        self.dispatcher.add_handler(history_handler)
+
+        devices_handler = CommandHandler('devices', self.list_devices)
+        self.dispatcher.add_handler(devices_handler)
+
+        sounds_handler = CommandHandler('sounds', self.list_sounds)
+        self.dispatcher.add_handler(sounds_handler)
+
+        upload_sound_handler = MessageHandler(Filters.audio | Filters.voice, self.upload_sound)
+        self.dispatcher.add_handler(upload_sound_handler)
+
         self.dispatcher.add_handler(CallbackQueryHandler(self.button))
 
         self.dispatcher.add_error_handler(self.error_callback)
@@ -355,6 +345,10 @@ class Bot:
         reply = handle_cancel(update)
         if reply is None:
             keyboard = []
+            if update.message.text not in get_timezones():
+                update.message.reply_text(emojize(":no_entry_sign: ", use_aliases=True) + 'No such continent: ' +
+                                          update.message.text)
+                return ConversationHandler.END
             self.selected_continent = update.message.text
             for continent in sorted(get_timezones()[self.selected_continent]):
                 keyboard.append([InlineKeyboardButton(continent)])
@@ -369,13 +363,13 @@ class Bot:
         if reply is None:
             timezone = self.selected_continent + "/" + update.message.text
 
-            timezone_script = os.path.join(DIR, "set_timezone.sh")
-
-            if os.path.isfile(os.path.join("/usr/share/zoneinfo/", timezone)):
-                print(run_command(["sudo", timezone_script, timezone]))
+            if timezone in pytz.all_timezones_set:
+                user_id = update.effective_user.id
+                set_user_timezone(self.engine, user_id, timezone)
+                self.crontab.set_owner_timezone(user_id, timezone)
                 update.message.reply_text(emojize(":clock4: ", use_aliases=True) + 'Timezone set set to: ' + timezone)
             else:
-                update.message.reply_text(emojize(":no_entry_sign: ", use_aliases=True) + 'Timezone file does not exist: ' + timezone)
+                update.message.reply_text(emojize(":no_entry_sign: ", use_aliases=True) + 'Timezone does not exist: ' + timezone)
 
             return ConversationHandler.END
         return ConversationHandler.END
@@ -411,18 +405,21 @@ class Bot:
             else:
 
                 data = data.split(":")
-                hour = int(data[0])
-                minute = int(data[1])
-
-                reply = emojize(":alarm_clock:", use_aliases=True) \
-                        + " Created " + self.selected_alarm_type + " alarm at: " + str(hour) + ":" + str(minute)
-
-                if self.selected_alarm_type == "Daily":
-                    self.crontab.add_daily(ALARM_COMMAND + " " +
-                                           os.path.abspath(os.path.join(DIR, "alarm.mp3")), hour, minute)
-                else:
-                    self.crontab.add_weekday(ALARM_COMMAND + " " +
-                                           os.path.abspath(os.path.join(DIR, "alarm.mp3")), hour, minute)
+                self.selected_hour = int(data[0])
+                self.selected_minute = int(data[1])
+
+                # Uploaded sounds are not sent to fleet devices
+                sounds = self.sounds.get_sounds(update.effective_user.id) if self.fleet is None else []
+                if len(sounds) > 0:
+                    keyboard = [[InlineKeyboardButton(DEFAULT_SOUND_NAME)]]
+                    for sound in sounds:
+                        keyboard.append([InlineKeyboardButton(sound.name)])
+                    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+                    update.message.reply_text('Select a sound for the alarm, or /cancel to cancel:',
+                                              reply_markup=reply_markup)
+                    return self.ALARM_SOUND
+
+                reply = self.create_alarm(update.effective_user.id, DEFAULT_SOUND)
 
             update.message.reply_text(reply)
         except ValueError as e:
@@ -433,6 +430,99 @@ class Bot:
             return self.ALARM_TYPE
         return ConversationHandler.END
 
+    def alarm_sound(self, bot, update):
+        reply = handle_cancel(update)
+        if reply is not None:
+            return ConversationHandler.END
+
+        sound_path = DEFAULT_SOUND
+        if update.message.text != DEFAULT_SOUND_NAME:
+            sound = self.sounds.get_sound(update.effective_user.id, update.message.text)
+            if sound is None:
+                update.message.reply_text("No such sound, select one from the list or /cancel to cancel")
+                return self.ALARM_SOUND
+            sound_path = self.sounds.sound_path(sound.digest)
+
+        update.message.reply_text(self.create_alarm(update.effective_user.id, sound_path))
+        return ConversationHandler.END
+
+    def create_alarm(self, user_id, sound_path):
+        """
+        Create an alarm from the selected type and time, in the timezone of the user
+
+        :param user_id: telegram id of the user that owns the alarm
+        :param sound_path: Path to the sound the alarm plays
+        :return: A reply describing the new alarm
+        """
+        hour = self.selected_hour
+        minute = self.selected_minute
+        command = ALARM_COMMAND + " " + sound_path
+        timezone = get_user_timezone(self.engine, user_id)
+
+        if self.selected_alarm_type == "Daily":
+            self.crontab.add_daily(command, hour, minute, user_id, timezone)
+        else:
+            self.crontab.add_weekday(command, hour, minute, user_id, timezone)
+
+        reply = emojize(":alarm_clock:", use_aliases=True) \
+            + " Created " + self.selected_alarm_type + " alarm at: " + str(hour) + ":" + str(minute)
+        if timezone is not None:
+            reply += " " + timezone
+        return reply
+
+    @restricted
+    def upload_sound(self, bot, update):
+        if self.fleet is not None:
+            update.message.reply_text("Alarms ring on the fleet devices, uploaded sounds are not sent there")
+            return
+
+        upload = update.message.audio or update.message.voice
+        user_id = update.effective_user.id
+        chat_id = update.message.chat_id
+
+        try:
+            self.sounds.check_upload(user_id, upload.file_size)
+        except SoundLibraryError as e:
+            update.message.reply_text(emojize(":no_entry_sign: ", use_aliases=True) + e.message)
+            return
+
+        name = update.message.caption or getattr(upload, "title", None) or "Sound " + time.strftime("%Y-%m-%d %H:%M")
+
+        def download(path):
+            bot.get_file(upload.file_id).download(custom_path=path)
+
+        def done(sound, error):
+            if error is None:
+                text = emojize(":musical_note: ", use_aliases=True) + 'Sound "' + sound.name + \
+                       '" is ready, pick it when creating an alarm with /new'
+            elif isinstance(error, SoundLibraryError):
+                text = emojize(":no_entry_sign: ", use_aliases=True) + error.message
+            else:
+                text = emojize(":no_entry_sign: ", use_aliases=True) + "Could not process the sound"
+            bot.send_message(chat_id=chat_id, text=text)
+
+        self.sounds.add_async(user_id, name, download, done)
+        update.message.reply_text("Processing sound, I will let you know when it is ready")
+        return
+
+    @restricted
+    def list_sounds(self, bot, update):
+        keyboard = []
+        for sound in self.sounds.get_sounds(update.effective_user.id):
+            icon = emojize(":x:", use_aliases=True)
+            delete_button = InlineKeyboardButton(icon, callback_data=build_callback(
+                {"command": "remove_sound", "sound": sound.id}))
+            keyboard.append([delete_button, InlineKeyboardButton(sound.name, callback_data=build_callback(
+                {"command": "close"}))])
+
+        if len(keyboard) == 0:
+            update.message.reply_text("You have no sounds, send me an audio or voice message to add one")
+            return
+
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        update.message.reply_text('Sound list:', reply_markup=reply_markup)
+        return
+
     def error_callback(self, bot, update, error):
         try:
             raise error
@@ -463,9 +553,12 @@ class Bot:
         commands = [["/new", "Create new alarm"],
                     ["/list", "List alarms, enable/disable and remove alarms"],
                     ["/stop", "Stop all alarms"],
-                    ["/timezone", "Set the timezone (only works if sudo requires no password)"],
+                    ["/timezone", "Set your timezone, your alarms ring at your local time"],
                     ["/test", "Play an alarm to test"],
-                    ["/time", "Print time and timezone on device"],
+                    ["/history", "When the last alarms rang and who stopped them"],
+                    ["/sounds", "List and remove your alarm sounds, send an audio or voice message to add one"],
+                    ["/time", "Print time and your timezone"],
+                    ["/devices", "Show which alarm devices are online"],
                     ["/help", "Get this message"]
                     ]
 
@@ -476,31 +569,70 @@ class Bot:
 
     @restricted
     def time(self, bot, update):
-        reply, _ = run_command(["date"])
+        timezone = get_user_timezone(self.engine, update.effective_user.id)
+        if timezone is None:
+            reply, _ = run_command(["date"])
+        else:
+            reply = datetime.now(pytz.timezone(timezone)).strftime("%a %b %d %H:%M:%S %Z %Y")
         bot.send_message(chat_id=update.message.chat_id, text=reply)
         return
 
     @restricted
     def test(self, bot, update):
-        run_command([ALARM_COMMAND, os.path.abspath(os.path.join(DIR, "alarm.mp3"))], False)
+        run_command([ALARM_COMMAND, DEFAULT_SOUND], False)
         reply = "Testing alarm! Send /stop to stop"
         bot.send_message(chat_id=update.message.chat_id, text=reply)
         return
 
     @restricted
     def stop_alarms(self, bot, update):
-        alarm_folder = os.path.expanduser(os.path.join("~", ".alarmbot"))
-        ensure_dir(alarm_folder)
-        lock_dir = alarm_folder
-        for lock_file in os.listdir(lock_dir):
-            try:
-                pid = int(lock_file.split(".lock")[0])
-                os.kill(pid, signal.SIGINT)
-            except (ValueError, ProcessLookupError):
-                 pass
+        stop_alarms(update.effective_user.full_name)
+        if self.fleet is not None:
+            self.fleet.stop(update.effective_user.full_name)
         bot.send_message(chat_id=update.message.chat_id, text="Stopping alarm!")
         return
 
+    @restricted
+    def list_devices(self, bot, update):
+        if self.fleet is None:
+            bot.send_message(chat_id=update.message.chat_id, text="Alarms ring on this device, there is no fleet")
+            return
+
+        text = emojize(":satellite: ", use_aliases=True) + "Alarm devices:\n"
+        for device in self.fleet.status():
+            text += device["name"] + ": " + ("online" if device["online"] else "offline")
+            if device["pending"] > 0:
+                text += ", " + str(device["pending"]) + " changes waiting"
+            text += "\n"
+        bot.send_message(chat_id=update.message.chat_id, text=text)
+        return
+
+    @restricted
+    def history(self, bot, update):
+        Session = sessionmaker()
+        Session.configure(bind=self.engine)
+        session = Session()
+        alarm_events = session.query(AlarmEvent).order_by(AlarmEvent.fired_at.desc()).limit(HISTORY_LENGTH).all()
+
+        if len(alarm_events) == 0:
+            bot.send_message(chat_id=update.message.chat_id, text="No alarms fired yet")
+            return
+
+        text = emojize(":alarm_clock: ", use_aliases=True) + "Last alarms:\n"
+        for alarm_event in alarm_events:
+            text += alarm_event.fired_at.strftime("%a %d/%m %H:%M")
+            if alarm_event.alarm_id is not None:
+                text += " " + alarm_event.alarm_id
+            if alarm_event.first_audio_at is not None and alarm_event.stopped_at is not None:
+                text += ", rang " + str(int((alarm_event.stopped_at - alarm_event.first_audio_at).total_seconds())) + "s"
+            if alarm_event.stopped_by is not None:
+                text += ", stopped by " + alarm_event.stopped_by
+            if alarm_event.latency_ms is not None:
+                text += ", latency " + str(alarm_event.latency_ms) + "ms"
+            text += "\n"
+        bot.send_message(chat_id=update.message.chat_id, text=text)
+        return
+
     @restricted
     def list_alarms(self, bot, update):
         keyboard = []
@@ -564,14 +696,181 @@ class Bot:
                         reply = "removing alarm: " + short_description(alarm)
                         self.crontab.remove(alarm)
 
+            if data["command"] == "remove_sound":
+                used_paths = {get_job_sound(job) for job in self.crontab.job_list()}
+                try:
+                    sound = self.sounds.remove(query.from_user.id, data["sound"], used_paths)
+                    if sound is not None:
+                        reply = "removing sound: " + sound.name
+                except SoundLibraryError as e:
+                    reply = emojize(":no_entry_sign: ", use_aliases=True) + e.message
+
+            if data["command"] == "snooze":
+                reply = self.snooze(query.from_user, data["pid"], data["alarm"],
+                                    (query.message.chat_id, query.message.message_id))
+
             if data["command"] == "close":
                 reply = "Closed"
 
         bot.edit_message_text(text=reply, chat_id=query.message.chat_id, message_id=query.message.message_id)
         return
 
+    def alarm_recipients(self, alarm_id):
+        """
+        Get who to tell an alarm is ringing, its owner, or all users for alarms without one
+
+        :return: A list of telegram ids
+        """
+        for job in self.crontab.job_list():
+            if get_job_id(job) == alarm_id and get_job_info(job).get("owner") is not None:
+                return [int(get_job_info(job)["owner"])]
+
+        Session = sessionmaker()
+        Session.configure(bind=self.engine)
+        session = Session()
+        users = session.query(TelegramUser).filter(TelegramUser.role.in_(["user", "admin"])).all()
+        session.close()
+        return [user.id for user in users]
+
+    def alarm_description(self, alarm_id, sound):
+        for job in self.crontab.job_list():
+            if get_job_id(job) == alarm_id:
+                return short_description(job)
+        return "Test alarm" if sound is None else sound
+
+    def on_alarm_event(self, kind, data, version):
+        # Called from the alarm watcher thread, send from the job queue
+        if kind == events.ALARM_FIRED:
+            self.updater.job_queue.run_once(self.send_ringing, 0, context=data)
+        elif kind == events.ALARM_STOPPED:
+            self.updater.job_queue.run_once(self.send_stopped, 0, context=data)
+        return
+
+    def send_ringing(self, bot, job):
+        alarm = job.context
+        minutes = snooze_minutes(get_config())
+        snooze = build_callback({"command": "snooze", "pid": alarm["pid"], "alarm": alarm["alarm"]})
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+            emojize(":zzz: ", use_aliases=True) + "Snooze " + str(minutes) + " min", callback_data=snooze)]])
+        text = emojize(":alarm_clock: ", use_aliases=True) + "Ringing: " + \
+            self.alarm_description(alarm["alarm"], alarm["sound"]) + "\nSend /stop to stop"
+
+        messages = []
+        for telegram_id in self.alarm_recipients(alarm["alarm"]):
+            try:
+                message = bot.send_message(chat_id=telegram_id, text=text, reply_markup=reply_markup)
+                messages.append((message.chat_id, message.message_id))
+            except TelegramError as e:
+                print("Could not tell " + str(telegram_id) + " an alarm is ringing: " + str(e))
+        self.ringing_messages[alarm["pid"]] = messages
+        return
+
+    def send_stopped(self, bot, job):
+        alarm = job.context
+        text = emojize(":alarm_clock: ", use_aliases=True) + "Stopped: " + \
+            self.alarm_description(alarm["alarm"], alarm["sound"])
+        if alarm["stopped_by"] is not None:
+            text += ", by " + alarm["stopped_by"]
+        self.edit_ringing_messages(bot, alarm["pid"], text)
+        return
+
+    def edit_ringing_messages(self, bot, pid, text, skip=None):
+        """
+        Replace the ringing messages of an alarm, which removes their snooze button
+        """
+        for chat_id, message_id in self.ringing_messages.pop(pid, []):
+            if (chat_id, message_id) == skip:
+                continue
+            try:
+                bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+            except TelegramError:
+                # Deleted by the user
+                pass
+        return
+
+    def snooze(self, user, pid, alarm_id, message):
+        """
+        Stop a ringing alarm and ring it again in [alarm] snooze_minutes
+
+        :param message: (chat id, message id) of the pressed button, its message gets the reply
+
+        :return: The reply to show
+        """
+        if not has_access(self.role_cache, user.id, ["user", "admin"]):
+            return "You have no permission to snooze alarms, use web UI to give authorization."
+        if pid not in self.ringing_messages:
+            return "This alarm is not ringing anymore"
+
+        # Read before the alarm exits, it may play an uploaded sound or the test sound
+        sound, _ = read_alarm_command(pid)
+        if sound is None:
+            sound = DEFAULT_SOUND
+            for job in self.crontab.job_list():
+                if get_job_id(job) == alarm_id:
+                    sound = get_job_sound(job)
+        stop_alarm(pid, "snoozed by " + user.full_name)
+
+        minutes = snooze_minutes(get_config())
+        fire_at = self.snoozes.snooze(sound, alarm_id, minutes, user.full_name)
+        timezone = get_user_timezone(self.engine, user.id)
+        fire_time = datetime.fromtimestamp(fire_at, pytz.timezone(timezone) if timezone else None)
+        reply = emojize(":zzz: ", use_aliases=True) + "Snoozed by " + user.full_name + " until " + \
+            fire_time.strftime("%H:%M")
+        self.edit_ringing_messages(self.updater.bot, pid, reply, skip=message)
+        return reply
+
+    def fire_alarm(self, sound, alarm_id):
+        command = [ALARM_COMMAND, sound]
+        if alarm_id is not None:
+            command += ["--alarm-id", alarm_id]
+        run_command(command, False)
+        return
+
+    def watch_config(self):
+        """
+        Mark the settings that can change while running, and apply them when they do
+        """
+        on_config_change("main", ["log_level"], self.apply_log_level)
+        on_config_change("sounds", ["workers", "max_per_user", "max_mb_per_user", "max_upload_mb", "max_seconds"],
+                         self.sounds.apply_settings)
+        if self.warmup is not None:
+            on_config_change("warmup", ["lead_seconds"], self.apply_warmup_settings)
+        if self.fleet is not None:
+            on_config_change("fleet", ["batch_ms", "retry_seconds"], self.fleet.apply_settings)
+        # Read by every alarm process when it starts, and when an alarm is snoozed
+        on_config_change("alarm", ["volume", "overlap", "snooze_minutes"])
+        self.updater.job_queue.run_repeating(self.check_config, interval=CONFIG_CHECK_SECONDS,
+                                             first=CONFIG_CHECK_SECONDS)
+        return
+
+    def apply_log_level(self, settings):
+        logging.getLogger().setLevel(settings.get_value("main", "log_level", "INFO").upper())
+        return
+
+    def apply_warmup_settings(self, settings):
+        self.warmup.lead_seconds = settings.get_int("warmup", "lead_seconds", DEFAULT_LEAD_SECONDS)
+        return
+
+    def check_config(self, bot, job):
+        reload_config()
+        return
+
+    def sync_timezones(self, bot, job):
+        self.crontab.sync_timezones()
+        return
+
     def run(self):
         self.updater.start_polling()
+        self.updater.job_queue.run_repeating(self.sync_timezones, interval=60, first=0)
+        self.watch_config()
+        if self.warmup is not None:
+            self.warmup.start()
+        if self.fleet is not None:
+            self.fleet.start()
+        if self.snoozes is not None:
+            self.snoozes.start()
+            events.subscribe(self.on_alarm_event)
+            get_alarm_watcher()
         return
 
 
@@ -595,13 +894,26 @@ def mysql_init_db(uri, settings):
     return
 
 if __name__ == "__main__":
-    from common import get_config, CONFIG_PATH, get_uri_without_db, get_uri
-    from webserver import webserver
+    from common import CONFIG_PATH, get_uri_without_db, get_uri
+    import memory
 
     settings = get_config()
-
-    mysql_init_db(get_uri_without_db(settings), settings)
-    webserver.init_db(get_uri(settings))
+    memory.start_tracing(settings)
+    memory.install_signal_handler()
+    on_config_change("memory", ["tracemalloc", "tracemalloc_frames"], memory.start_tracing)
+    # Read by memory.py when it checks the bot
+    on_config_change("memory", ["rss_budget_mb"])
+
+    # The webserver pulls in flask and its extensions, only load it when used
+    webserver_enabled = settings.get_bool("webserver", "enabled", True)
+
+    if "uri" not in settings["db"]:
+        mysql_init_db(get_uri_without_db(settings), settings)
+    if webserver_enabled:
+        from webserver import webserver
+        webserver.init_db(get_uri(settings))
+    else:
+        create_tables(create_engine(get_uri(settings)))
 
     if not CONFIG_PATH:
         print("Error, no config file")
@@ -616,5 +928,8 @@ if __name__ == "__main__":
     a.run()
     print("Bot Started")
 
-    webserver.run()
-    print("Webserver started")
+    if webserver_enabled:
+        webserver.run()
+        print("Webserver started")
+    else:
+        a.updater.idle()
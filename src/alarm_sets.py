@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Export and import all alarms as json, to move them between devices or restore them after reflashing
+
+Importing makes the alarms of the device match the file with a single crontab write,
+and importing the same file again changes nothing.
+"""
+import os
+import re
+import sys
+import json
+from common import ALARM_COMMAND, DEFAULT_SOUND, SOUNDS_DIR, LIBRARY_PREFIX
+from cron_jobs import get_cron_jobs, get_job_id, get_job_info, get_local_schedule, parse_alarm_command
+
+FORMAT_VERSION = 1
+
+ALARM_ID = re.compile("[A-Za-z0-9]{1,8}")
+TELEGRAM_ID = re.compile("-?[0-9]+")
+LIBRARY_SOUND = re.compile(re.escape(LIBRARY_PREFIX) + "[0-9a-f]{64}")
+
+# Sound paths become part of a cron command line, no spaces or shell characters
+SAFE_PATH = re.compile("[A-Za-z0-9_./-]+")
+
+# Folders imported sound files may be in
+SOUND_DIRS = [os.path.dirname(DEFAULT_SOUND), SOUNDS_DIR]
+
+# Imported sound files must be audio, not the config or the code next to the default sound
+SOUND_EXTENSIONS = [".mp3", ".wav", ".ogg", ".oga", ".flac", ".m4a"]
+
+
+class AlarmSetError(Exception):
+    def __init__(self, message=""):
+        self.message = message
+
+
+def export_sound(sound_path):
+    if os.path.abspath(sound_path) == DEFAULT_SOUND:
+        return None
+    if os.path.dirname(os.path.abspath(sound_path)) == SOUNDS_DIR:
+        return LIBRARY_PREFIX + os.path.splitext(os.path.basename(sound_path))[0]
+    return sound_path
+
+
+def export_owner(owner):
+    try:
+        return None if owner is None else int(owner)
+    except ValueError:
+        return None
+
+
+def import_sound(sound):
+    """
+    Get the path of an exported sound
+
+    :raises AlarmSetError: if it is not the default sound, a library sound or an audio file of this device
+    """
+    if sound is None:
+        return DEFAULT_SOUND
+    if not isinstance(sound, str):
+        raise AlarmSetError("Sound must be a string")
+    if LIBRARY_SOUND.fullmatch(sound):
+        return os.path.join(SOUNDS_DIR, sound[len(LIBRARY_PREFIX):] + ".wav")
+
+    path = os.path.realpath(sound)
+    if not SAFE_PATH.fullmatch(path) or not os.path.isfile(path) or \
+            os.path.splitext(path)[1].lower() not in SOUND_EXTENSIONS or \
+            os.path.dirname(path) not in [os.path.realpath(sound_dir) for sound_dir in SOUND_DIRS]:
+        raise AlarmSetError("Sound must be a library sound or a sound file of the alarm bot: " + json.dumps(sound))
+    return path
+
+
+def export_alarms(crontab):
+    """
+    Get all alarms of crontab in the export format
+
+    :param crontab: A CronJobs
+    :return: A dict that can be dumped as json
+    """
+    alarms = []
+    for job in crontab.job_list():
+        info = get_job_info(job)
+        minute, hour, dows = get_local_schedule(job)
+        alarms.append({"id": get_job_id(job),
+                       "minute": minute,
+                       "hour": hour,
+                       "days": dows,
+                       "timezone": info.get("tz"),
+                       "owner": export_owner(info.get("owner")),
+                       "enabled": job.is_enabled(),
+                       "sound": export_sound(parse_alarm_command(job.command)[0])})
+    return {"version": FORMAT_VERSION, "alarms": alarms}
+
+
+def to_spec(alarm):
+    """
+    Validate an exported alarm and convert it to a CronJobs.import_jobs spec
+
+    :raises AlarmSetError: if the alarm is not valid
+    """
+    if not isinstance(alarm, dict):
+        raise AlarmSetError("Alarm must be an object: " + json.dumps(alarm))
+    try:
+        alarm_id = str(alarm["id"])
+        minute = int(alarm["minute"])
+        hour = int(alarm["hour"])
+        days = alarm.get("days")
+        if days is not None:
+            days = sorted(set(int(day) % 7 for day in days))
+    except (KeyError, TypeError, ValueError):
+        raise AlarmSetError("Alarm is missing id, minute or hour: " + json.dumps(alarm))
+
+    if not ALARM_ID.fullmatch(alarm_id):
+        raise AlarmSetError("Alarm id must be letters and digits: " + json.dumps(alarm_id))
+    if not (0 <= minute < 60 and 0 <= hour < 24):
+        raise AlarmSetError("Alarm " + alarm_id + " has an invalid time")
+
+    try:
+        sound = import_sound(alarm.get("sound"))
+    except AlarmSetError as e:
+        raise AlarmSetError("Alarm " + alarm_id + ": " + e.message)
+
+    timezone = alarm.get("timezone")
+    if timezone is not None:
+        # Imported here so exporting does not need pytz loaded
+        import pytz
+        if not isinstance(timezone, str) or timezone not in pytz.all_timezones_set:
+            raise AlarmSetError("Alarm " + alarm_id + " has an unknown timezone: " + json.dumps(timezone))
+
+    # The owner is written to the crontab comment, only a telegram id is safe there.
+    # Exports from before owners were numbers have them as strings of digits.
+    owner = alarm.get("owner")
+    if isinstance(owner, str) and TELEGRAM_ID.fullmatch(owner):
+        owner = int(owner)
+    if owner is not None and (not isinstance(owner, int) or isinstance(owner, bool)):
+        raise AlarmSetError("Alarm " + alarm_id + " owner must be a telegram id")
+
+    enabled = alarm.get("enabled", True)
+    if not isinstance(enabled, bool):
+        raise AlarmSetError("Alarm " + alarm_id + " enabled must be true or false")
+    return {"id": alarm_id,
+            "command": ALARM_COMMAND + " " + sound,
+            "minute": minute,
+            "hour": hour,
+            "dows": days,
+            "owner": None if owner is None else str(owner),
+            "timezone": timezone,
+            "enabled": enabled}
+
+
+def import_alarms(crontab, data, prune=False):
+    """
+    Make the alarms of crontab match an export, nothing is changed if any alarm is invalid
+
+    :param crontab: A CronJobs
+    :param data: A dict in the export format
+    :param prune: Remove alarms that are not in the export
+    :return: A dict of added, updated, unchanged and removed alarm ids
+    :raises AlarmSetError: if the export is not valid
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("alarms"), list):
+        raise AlarmSetError("Not an alarm export")
+    if data.get("version") != FORMAT_VERSION:
+        raise AlarmSetError("Unsupported alarm export version: " + str(data.get("version")))
+
+    specs = [to_spec(alarm) for alarm in data["alarms"]]
+    ids = [spec["id"] for spec in specs]
+    if len(set(ids)) != len(ids):
+        raise AlarmSetError("Alarm ids must be unique")
+    return crontab.import_jobs(specs, prune)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(add_help=True, description="Export and import all alarms as json")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export", help="Write all alarms as json")
+    export_parser.add_argument('path', type=str, nargs="?", default="-", help='File to write, - for stdout')
+
+    import_parser = subparsers.add_parser("import", help="Make the alarms match a json export")
+    import_parser.add_argument('path', type=str, help='File to read, - for stdin')
+    import_parser.add_argument('--prune', action='store_true', help='Remove alarms that are not in the file')
+    args = parser.parse_args()
+
+    crontab = get_cron_jobs("alarmbot")
+    if args.command == "export":
+        text = json.dumps(export_alarms(crontab), indent=2)
+        if args.path == "-":
+            print(text)
+        else:
+            with open(args.path, "w") as f:
+                f.write(text + "\n")
+    else:
+        if args.path == "-":
+            data = json.load(sys.stdin)
+        else:
+            with open(args.path) as f:
+                data = json.load(f)
+        try:
+            summary = import_alarms(crontab, data, args.prune)
+        except AlarmSetError as e:
+            print("Error: " + e.message)
+            sys.exit(1)
+        for key in ["added", "updated", "removed", "unchanged"]:
+            print(key.capitalize() + ": " + str(len(summary[key])))
@@ -0,0 +1,160 @@
+"""
+Publish when alarms start and stop ringing
+
+Alarms are played by processes cron starts, which hold a <pid>.lock file in ~/.alarmbot while they ring.
+The watcher polls that folder and publishes ALARM_FIRED and ALARM_STOPPED events in this process.
+"""
+import os
+import signal
+import threading
+import traceback
+import events
+from cron_jobs import parse_alarm_command
+
+LOCK_DIR = os.path.expanduser(os.path.join("~", ".alarmbot"))
+
+POLL_INTERVAL = 1
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def read_alarm_command(pid):
+    """
+    Get the sound and alarm id a running alarm process was started with
+
+    :return: (sound file, alarm id), both None if the process is gone
+    """
+    try:
+        with open(os.path.join("/proc", str(pid), "cmdline"), "rb") as f:
+            arguments = f.read().decode(errors="replace").strip("\0").split("\0")
+    except OSError:
+        return None, None
+    return parse_alarm_command(" ".join(arguments))
+
+
+def read_lock_file(lock_path):
+    try:
+        with open(lock_path) as f:
+            return f.read().strip()[:64] or None
+    except OSError:
+        return None
+
+
+def stop_alarm(pid, stopped_by, lock_dir=LOCK_DIR):
+    """
+    Stop one ringing alarm
+
+    :param pid: Process id of the alarm
+    :param stopped_by: Name recorded in the alarm history
+    :return: True if the alarm was signaled
+    """
+    lock_path = os.path.join(lock_dir, str(pid) + ".lock")
+    if not os.path.isfile(lock_path):
+        return False
+    try:
+        # Recorded in the alarm history by the alarm process
+        with open(lock_path, "w") as f:
+            f.write(stopped_by)
+        os.kill(pid, signal.SIGINT)
+    except (ProcessLookupError, OSError):
+        return False
+    return True
+
+
+def stop_alarms(stopped_by, lock_dir=LOCK_DIR):
+    """
+    Stop all ringing alarms
+
+    :param stopped_by: Name recorded in the alarm history
+    :return: The number of alarms signaled
+    """
+    stopped = 0
+    try:
+        lock_files = os.listdir(lock_dir)
+    except OSError:
+        return stopped
+    for lock_file in lock_files:
+        try:
+            pid = int(lock_file.split(".lock")[0])
+        except ValueError:
+            continue
+        if stop_alarm(pid, stopped_by, lock_dir):
+            stopped += 1
+    return stopped
+
+
+def get_alarm_watcher():
+    """
+    Get the watcher of this process, started on first use so every event is published once
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = AlarmWatcher()
+            _watcher.start()
+    return _watcher
+
+
+class AlarmWatcher(threading.Thread):
+    def __init__(self, lock_dir=LOCK_DIR, interval=POLL_INTERVAL):
+        """
+        :param lock_dir: Folder alarm processes keep their lock files in
+        :param interval: Seconds between polls
+        """
+        super(AlarmWatcher, self).__init__()
+        self.daemon = True
+        self.lock_dir = lock_dir
+        self.interval = interval
+        self.ringing = {}
+        self.closing = threading.Event()
+
+    def lock_pids(self):
+        pids = set()
+        try:
+            lock_files = os.listdir(self.lock_dir)
+        except OSError:
+            return pids
+        for lock_file in lock_files:
+            if lock_file.endswith(".lock"):
+                try:
+                    pids.add(int(lock_file[:-len(".lock")]))
+                except ValueError:
+                    pass
+        return pids
+
+    def poll(self):
+        pids = self.lock_pids()
+        for pid in pids - set(self.ringing.keys()):
+            sound, alarm_id = read_alarm_command(pid)
+            self.ringing[pid] = {"pid": pid, "alarm": alarm_id,
+                                 "sound": None if sound is None else os.path.basename(sound), "stopped_by": None}
+            events.publish(events.ALARM_FIRED, **self.ringing[pid])
+
+        for pid, alarm in list(self.ringing.items()):
+            if pid in pids:
+                # The bot writes who stops an alarm in its lock file just before the alarm exits
+                alarm["stopped_by"] = read_lock_file(os.path.join(self.lock_dir, str(pid) + ".lock"))
+            else:
+                del self.ringing[pid]
+                events.publish(events.ALARM_STOPPED, **alarm)
+        return
+
+    def ringing_alarms(self):
+        """
+        :return: A list of the alarms that are ringing now
+        """
+        return [dict(alarm) for alarm in list(self.ringing.values())]
+
+    def run(self):
+        while not self.closing.is_set():
+            try:
+                self.poll()
+            except Exception:
+                print(str(traceback.format_exc()))
+            self.closing.wait(self.interval)
+        return
+
+    def close(self):
+        self.closing.set()
+        return
@@ -0,0 +1,464 @@
+"""
+A single owner of the audio device for all alarm processes
+
+Every alarm is its own alarm.py process started by cron. The first one to take the owner lock opens
+the audio device and plays. Alarms that start while it rings connect to the owner over a unix socket
+instead of opening their own stream, and stay connected until they are stopped. The owner keeps
+one decode per distinct sound and one output stream, and applies the overlap policy:
+
+    coalesce    a new alarm joins the sound that is already ringing
+    queue       alarms with a different sound wait until the ringing ones are stopped
+    mix         different sounds are mixed into the output stream
+
+Alarms with the same sound and volume always share one decode. Every alarm sends its own [alarm] volume.
+The process that owns the audio device keeps running after its own alarm is stopped, without its lock file,
+until the alarms it plays for other processes are stopped too.
+"""
+import os
+import json
+import time
+import fcntl
+import mmap
+import socket
+import threading
+import warnings
+from array import array
+from collections import OrderedDict
+from common import STREAM_FRAME_RATE, STREAM_CHANNELS, STREAM_SAMPLE_WIDTH, STREAM_BLOCK_SIZE
+
+ALARM_DIR = os.path.expanduser(os.path.join("~", ".alarmbot"))
+SOCKET_PATH = os.path.join(ALARM_DIR, "player.sock")
+OWNER_LOCK_PATH = os.path.join(ALARM_DIR, "player.lock")
+
+COALESCE = "coalesce"
+QUEUE = "queue"
+MIX = "mix"
+POLICIES = [COALESCE, QUEUE, MIX]
+DEFAULT_POLICY = MIX
+
+SAMPLE_MIN = -32768
+SAMPLE_MAX = 32767
+
+try:
+    # Mixes in C, deprecated and removed in python 3.13
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+
+def mix_blocks(blocks):
+    """
+    Mix blocks of signed 16 bit samples, clipping the sum
+
+    :param blocks: A list of bytes of the same length
+    :return: The mixed block
+    """
+    if len(blocks) == 1:
+        return blocks[0]
+    if audioop is not None:
+        mixed = blocks[0]
+        for block in blocks[1:]:
+            mixed = audioop.add(mixed, block, STREAM_SAMPLE_WIDTH)
+        return mixed
+
+    sums = [sum(values) for values in zip(*[array("h", block) for block in blocks])]
+    # Clipping is rare, only pay for it when it happens
+    if min(sums) < SAMPLE_MIN or max(sums) > SAMPLE_MAX:
+        sums = [max(SAMPLE_MIN, min(SAMPLE_MAX, value)) for value in sums]
+    return array("h", sums).tobytes()
+
+
+class MappedSource:
+    """
+    Loop over a PCM wav already in the output format, straight from a memory map
+    """
+
+    def __init__(self, path, offset, length):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        frame_size = STREAM_CHANNELS * STREAM_SAMPLE_WIDTH
+        # pydub writes 0xFFFFFFFF as the data length when it streams the header
+        length = min(length, len(self.data) - offset)
+        self.start = offset
+        self.end = offset + length - (length % frame_size)
+        self.position = self.start
+
+    def read(self, size):
+        if self.end <= self.start:
+            return None
+        block = bytearray()
+        while len(block) < size:
+            part = self.data[self.position:min(self.position + size - len(block), self.end)]
+            block += part
+            self.position += len(part)
+            if self.position >= self.end:
+                self.position = self.start
+        return bytes(block)
+
+    def close(self):
+        self.data.close()
+
+
+class DecodedSource:
+    """
+    Loop over any file the decoder can read, decoded to the output format
+    """
+
+    def __init__(self, path, volume):
+        # Imported here, the alarm module loads pydub, pyaudio and the history writer
+        from alarm import StreamingPlayerLoop
+        self.player = StreamingPlayerLoop(path, volume=volume)
+        self.blocks = self.loop_blocks()
+        self.buffer = bytearray()
+
+    def loop_blocks(self):
+        while self.player.loop:
+            played = False
+            for block in self.player.decoded_blocks():
+                played = True
+                yield block
+            if not played:
+                # Nothing could be decoded, avoid spinning on a broken file
+                return
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            block = next(self.blocks, None)
+            if block is None:
+                return None
+            self.buffer += block
+        block = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return block
+
+    def close(self):
+        self.player.stop()
+
+
+def open_source(path, volume):
+    """
+    Open a sound for the owner, without decoding when it is a wav in the output format
+    """
+    if volume == 100.0:
+        from alarm import find_pcm_data
+        try:
+            with open(path, "rb") as f:
+                pcm = find_pcm_data(f)
+        except (OSError, ValueError):
+            pcm = None
+        if pcm is not None and pcm[2:] == (STREAM_CHANNELS, STREAM_FRAME_RATE, STREAM_SAMPLE_WIDTH):
+            return MappedSource(path, pcm[0], pcm[1])
+    return DecodedSource(path, volume)
+
+
+class Sound:
+    def __init__(self, path, volume, source):
+        self.path = path
+        self.volume = volume
+        self.source = source
+        # Alarms listening to this sound, each with a callback for when it is first heard
+        self.listeners = OrderedDict()
+
+
+class AudioOwner:
+    def __init__(self, policy=DEFAULT_POLICY, socket_path=SOCKET_PATH):
+        """
+        :param policy: One of POLICIES
+        :param socket_path: Unix socket other alarm processes connect to
+        """
+        self.policy = policy
+        self.socket_path = socket_path
+        self.sounds = OrderedDict()
+        self.lock = threading.Condition()
+        self.closing = False
+        self.server = None
+        self.next_listener = 0
+
+    def add(self, path, volume, on_playing):
+        """
+        Start an alarm
+
+        :param path: Sound to play
+        :param volume: Volume in percent the alarm process read from its config
+        :param on_playing: Called with a timestamp when the alarm is first heard
+        :return: An id to remove the alarm with
+        """
+        key = (path, volume)
+        with self.lock:
+            if self.policy == COALESCE and len(self.sounds) > 0 and key not in self.sounds:
+                # Ring the sound that is already ringing
+                key = next(iter(self.sounds))
+            sound = self.sounds.get(key)
+            if sound is None:
+                sound = Sound(path, volume, open_source(path, volume))
+                self.sounds[key] = sound
+            self.next_listener += 1
+            sound.listeners[self.next_listener] = on_playing
+            self.lock.notify_all()
+            return self.next_listener
+
+    def remove(self, listener):
+        with self.lock:
+            for key, sound in list(self.sounds.items()):
+                if listener in sound.listeners:
+                    del sound.listeners[listener]
+                    if len(sound.listeners) == 0:
+                        sound.source.close()
+                        del self.sounds[key]
+            self.lock.notify_all()
+        return
+
+    def audible(self):
+        sounds = list(self.sounds.values())
+        if self.policy == MIX:
+            return sounds
+        return sounds[:1]
+
+    def next_block(self):
+        """
+        :return: The next mixed block, None when no alarm is ringing
+        """
+        blocks = []
+        heard = []
+        with self.lock:
+            for sound in self.audible():
+                block = sound.source.read(STREAM_BLOCK_SIZE)
+                if block is None:
+                    continue
+                blocks.append(block)
+                for listener, on_playing in list(sound.listeners.items()):
+                    if on_playing is not None:
+                        heard.append(on_playing)
+                        sound.listeners[listener] = None
+
+        # Called outside the lock, they may write to a socket
+        now = time.time()
+        for on_playing in heard:
+            on_playing(now)
+        if len(blocks) == 0:
+            return None
+        return mix_blocks(blocks)
+
+    def play(self):
+        """
+        Play until no alarm is ringing, then stop taking new alarms
+        """
+        import pyaudio
+        player = pyaudio.PyAudio()
+        stream = player.open(format=player.get_format_from_width(STREAM_SAMPLE_WIDTH),
+                             channels=STREAM_CHANNELS,
+                             rate=STREAM_FRAME_RATE,
+                             output=True)
+        while True:
+            block = self.next_block()
+            if block is None:
+                with self.lock:
+                    if len(self.sounds) == 0:
+                        # Checked under the lock, an alarm connecting now gets refused and takes over
+                        self.close_server()
+                        break
+                    # Only sounds that can not be decoded are left
+                    self.lock.wait(0.5)
+                continue
+            stream.write(block)
+
+        stream.close()
+        player.terminate()
+        return
+
+    def serve(self):
+        """
+        Take alarms from other processes on the unix socket
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(8)
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+        return
+
+    def close_server(self):
+        self.closing = True
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        return
+
+    def accept(self):
+        while not self.closing:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.serve_alarm, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve_alarm(self, connection):
+        f = connection.makefile("rwb")
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                try:
+                    f.write(json.dumps(message).encode() + b"\n")
+                    f.flush()
+                except OSError:
+                    pass
+
+        listener = None
+        try:
+            request = json.loads(f.readline().decode())
+            with self.lock:
+                if self.closing:
+                    return
+                listener = self.add(str(request["sound"]), float(request.get("volume", 100.0)),
+                                    lambda playing_at: send({"playing": playing_at}))
+            send({"accepted": True})
+            # The alarm stays connected while it rings, and closes the connection when stopped
+            while f.readline():
+                pass
+        except (OSError, ValueError, TypeError, KeyError):
+            pass
+        finally:
+            if listener is not None:
+                self.remove(listener)
+            connection.close()
+        return
+
+
+def take_owner_lock(path=OWNER_LOCK_PATH):
+    """
+    :return: An open file holding the owner lock, None if another process owns the audio device
+    """
+    f = open(path, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class OwnedAlarm:
+    """
+    An alarm of this process, played by the owner in this process
+    """
+    remote = False
+
+    def __init__(self, owner, path, volume, owner_lock):
+        self.owner = owner
+        self.owner_lock = owner_lock
+        self.first_audio = None
+        self.listener = owner.add(path, volume, self.on_playing)
+        owner.serve()
+        self.thread = threading.Thread(target=owner.play)
+        self.thread.start()
+
+    def on_playing(self, playing_at):
+        self.first_audio = playing_at
+
+    def ringing(self):
+        return self.thread.is_alive()
+
+    def stop(self):
+        self.owner.remove(self.listener)
+        return
+
+    def wait(self):
+        """
+        Keep playing alarms of other processes until they are stopped too, then give up the audio device
+        """
+        self.thread.join()
+        self.owner_lock.close()
+        return
+
+
+class RemoteAlarm:
+    """
+    An alarm of this process, played by the owner in another process
+    """
+    remote = True
+
+    def __init__(self, connection, path, volume):
+        self.connection = connection
+        self.first_audio = None
+        self.f = connection.makefile("rwb")
+        self.f.write(json.dumps({"sound": path, "volume": volume, "pid": os.getpid()}).encode() + b"\n")
+        self.f.flush()
+        self.connection.settimeout(5)
+        reply = self.read()
+        if reply is None or not reply.get("accepted"):
+            raise OSError("Audio owner did not accept the alarm")
+        self.connection.settimeout(None)
+        self.alive = True
+        thread = threading.Thread(target=self.listen)
+        thread.daemon = True
+        thread.start()
+
+    def read(self):
+        line = self.f.readline()
+        if not line:
+            return None
+        return json.loads(line.decode())
+
+    def listen(self):
+        try:
+            while True:
+                message = self.read()
+                if message is None:
+                    break
+                if "playing" in message and self.first_audio is None:
+                    self.first_audio = message["playing"]
+        except (OSError, ValueError):
+            pass
+        self.alive = False
+
+    def ringing(self):
+        """
+        :return: False if the owner went away, this process should take over
+        """
+        return self.alive
+
+    def stop(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+        return
+
+    def wait(self):
+        return
+
+
+def start_alarm(path, policy=DEFAULT_POLICY, volume=100.0):
+    """
+    Ring an alarm through the owner of the audio device, becoming the owner if there is none
+
+    :param policy: One of POLICIES, applied if this process becomes the owner
+    :param volume: Volume in percent of this alarm
+    :return: An OwnedAlarm or a RemoteAlarm, with first_audio, ringing(), stop() and wait()
+    """
+    if policy not in POLICIES:
+        policy = DEFAULT_POLICY
+    while True:
+        owner_lock = take_owner_lock()
+        if owner_lock is not None:
+            return OwnedAlarm(AudioOwner(policy), path, volume, owner_lock)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(SOCKET_PATH)
+            return RemoteAlarm(connection, path, volume)
+        except (OSError, ValueError):
+            # The owner is starting or just stopped, try again
+            connection.close()
+            time.sleep(0.05)
@@ -1,4 +1,6 @@
 import os.path
+import threading
+import traceback
 from configparser import ConfigParser
 from collections import OrderedDict
 
@@ -21,13 +23,173 @@ def ini_to_dict(path):
     return return_value
 
 
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.ini")
+CONFIG_PATH = os.environ.get("ALARMBOT_CONFIG", os.path.join(os.path.dirname(__file__), "config.ini"))
+
+ALARM_COMMAND = os.path.abspath(os.path.join(os.path.dirname(__file__), "alarm.py"))
+DEFAULT_SOUND = os.path.abspath(os.path.join(os.path.dirname(__file__), "alarm.mp3"))
+
+# Uploaded sounds, named by digest. Alarm sets refer to them as LIBRARY_PREFIX + digest.
+SOUNDS_DIR = os.path.expanduser(os.path.join("~", ".alarmbot", "sounds"))
+LIBRARY_PREFIX = "library:"
+
+# Output format of the streaming player and the audio owner, signed 16 bit stereo PCM
+STREAM_FRAME_RATE = 44100
+STREAM_CHANNELS = 2
+STREAM_SAMPLE_WIDTH = 2
+
+# Size of a single block handed from the decoder to the player, 50ms of audio
+STREAM_BLOCK_SIZE = STREAM_FRAME_RATE * STREAM_CHANNELS * STREAM_SAMPLE_WIDTH // 20
+
+
+def ensure_dir(d):
+    if not os.path.exists(d):
+        os.makedirs(d)
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Config(OrderedDict):
+    """
+    Sections of config.ini, every section an OrderedDict of string values, with typed getters
+    """
+
+    def __init__(self, path):
+        # Taken before reading, so a write during the read is noticed by the next check
+        self.mtime = get_mtime(path)
+        super(Config, self).__init__(ini_to_dict(path))
+        self.path = path
+
+    def get_value(self, section, key, default=None):
+        return self.get(section, {}).get(key, default)
+
+    def get_int(self, section, key, default=None):
+        return int(self.get_value(section, key, default))
+
+    def get_float(self, section, key, default=None):
+        return float(self.get_value(section, key, default))
+
+    def get_bool(self, section, key, default=False):
+        value = self.get_value(section, key)
+        if value is None:
+            return default
+        return value.lower() in ["on", "true", "yes", "1"]
+
+
+_config = None
+_config_lock = threading.RLock()
+
+# Settings that are applied while running, as (section, key) to a list of callbacks
+_config_callbacks = OrderedDict()
+
+# The config as it was at start, settings that need a restart keep these values
+_startup_config = None
 
 
 def get_config():
-    return ini_to_dict(CONFIG_PATH)
+    """
+    Get the config, parsed once and shared by the whole process
+
+    Sections are replaced in place when the file changes, see reload_config
+    """
+    global _config, _startup_config
+    with _config_lock:
+        if _config is None:
+            _config = Config(CONFIG_PATH)
+            _startup_config = OrderedDict((section, OrderedDict(values)) for section, values in _config.items())
+        return _config
+
+
+def on_config_change(section, keys, callback=None):
+    """
+    Mark settings as safe to change while running
+
+    :param section: Config section
+    :param keys: Keys in the section
+    :param callback: Called with the new config when one of the keys changed,
+                     None for settings that are read again on every use
+    """
+    with _config_lock:
+        for key in keys:
+            callbacks = _config_callbacks.setdefault((section, key), [])
+            if callback is not None:
+                callbacks.append(callback)
+    return
+
+
+def changed_settings(old, new):
+    changed = []
+    for section in set(old.keys()) | set(new.keys()):
+        old_section = old.get(section, {})
+        new_section = new.get(section, {})
+        for key in set(old_section.keys()) | set(new_section.keys()):
+            if old_section.get(key) != new_section.get(key):
+                changed.append((section, key))
+    return sorted(changed)
+
+
+def reload_config():
+    """
+    Read the config again if the file changed, apply the settings that can change while running
+
+    :return: (a list of applied (section, key), a list of (section, key) that need a restart)
+    """
+    config = get_config()
+    if get_mtime(config.path) == config.mtime:
+        return [], []
+
+    with _config_lock:
+        new_config = Config(config.path)
+        changed = changed_settings(config, new_config)
+
+        # Replace whole sections, so readers never see a half updated one
+        for section in list(config.keys()):
+            if section not in new_config:
+                del config[section]
+        for section, values in new_config.items():
+            config[section] = values
+        config.mtime = new_config.mtime
+
+        applied = [setting for setting in changed if setting in _config_callbacks]
+        # A setting changed back to its value at start needs no restart
+        restart = [setting for setting in changed if setting not in _config_callbacks
+                   and _startup_config.get(setting[0], {}).get(setting[1]) != config.get_value(*setting)]
+        callbacks = []
+        for setting in applied:
+            for callback in _config_callbacks[setting]:
+                if callback not in callbacks:
+                    callbacks.append(callback)
+
+    for callback in callbacks:
+        try:
+            callback(config)
+        except Exception:
+            print(str(traceback.format_exc()))
+
+    if len(applied) > 0:
+        print("Applied config changes: " + ", ".join(section + "." + key for section, key in applied))
+    if len(restart) > 0:
+        print("Config changes that need a restart: " + ", ".join(section + "." + key for section, key in restart))
+    return applied, restart
+
+
+def restart_needed():
+    """
+    :return: A list of (section, key) that changed since start and need a restart to apply
+    """
+    config = get_config()
+    with _config_lock:
+        return [setting for setting in changed_settings(_startup_config, config) if setting not in _config_callbacks]
+
 
 def get_uri(settings):
+    # A full database uri, for example a sqlite file for the load test, replaces the mysql settings
+    if "uri" in settings["db"]:
+        return settings["db"]["uri"]
     return "mysql+mysqlconnector://" + settings["db"]["user"] \
                                           + ":" + settings["db"]["password"] + \
                                           "@" + settings["db"]["host"] +"/" + settings["db"]["db_name"]
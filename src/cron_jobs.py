@@ -0,0 +1,458 @@
+"""
+Manage alarms stored as crontab lines
+
+Every alarm line has a comment of the form::
+
+    alarmbot <id> owner=<telegram id> local=<minute>:<hour>:<days of week> tz=<timezone>
+
+Only the first two fields are required, alarms without a tz ring in the device timezone.
+
+Other processes change the same crontab, like an alarm set imported from the command line while the bot runs.
+It is read again before every change, and before reads when it changed since it was last read.
+"""
+import os
+import time
+import threading
+import traceback
+import random
+import string
+from crontab import CronTab
+import events
+from cron_descriptor import ExpressionDescriptor
+from timezones import FireTimeTable, system_schedule, parse_dows, format_dows, get_timezone
+
+# cron days of week of "Weekday Only" alarms, Sunday to Thursday
+WEEKDAYS = [0, 1, 2, 3, 4]
+
+# A user crontab has no file to check for changes, it is read again for reads at most this often
+REFRESH_SECONDS = 5
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+class CronJobsError(Exception):
+    def __init__(self, message = ""):
+        self.message = message
+
+
+def get_id(existing_ids=[]):
+    new_id = ''.join(random.sample((string.ascii_uppercase+string.digits + string.ascii_lowercase),4))
+    if new_id in existing_ids:
+        return get_id(existing_ids)
+    return new_id
+
+
+def get_job_id(job):
+    try:
+        return job.comment.split(" ")[1]
+    except IndexError:
+        print(str(traceback.format_exc()))
+        return None
+
+
+def parse_alarm_command(command):
+    """
+    Get the arguments of an alarm.py command
+
+    :return: (sound file, alarm id or None for alarms created before ids were passed)
+    """
+    parts = command.split(" ")
+    alarm_id = None
+    if "--alarm-id" in parts:
+        i = parts.index("--alarm-id")
+        alarm_id = parts[i + 1]
+        del parts[i:i + 2]
+    return parts[-1], alarm_id
+
+
+def with_alarm_id(command, job_id):
+    """
+    Add the alarm id to an alarm.py command, the alarm reports it to the fire history
+    """
+    return command + " --alarm-id " + job_id
+
+
+def get_job_sound(job):
+    """
+    Get the sound file an alarm job plays, it is the last argument of the command
+    """
+    return parse_alarm_command(job.command)[0]
+
+
+def get_job_info(job):
+    """
+    Get the key=value fields stored in the comment of a job
+
+    :return: dict of the fields
+    """
+    return_value = {}
+    for field in job.comment.split(" ")[2:]:
+        if "=" in field:
+            key, value = field.split("=", 1)
+            return_value[key] = value
+    return return_value
+
+
+def build_comment(cron_id, job_id, info):
+    fields = [cron_id, job_id]
+    for key in ["owner", "local", "tz"]:
+        if info.get(key) is not None:
+            fields.append(key + "=" + str(info[key]))
+    return " ".join(fields)
+
+
+def get_local_schedule(job):
+    """
+    Get the time of an alarm in the timezone of its owner
+
+    :return: (minute, hour, days of week) where days of week is a list or None for every day
+    """
+    local = get_job_info(job).get("local")
+    if local is None:
+        return int(str(job.minute)), int(str(job.hour)), parse_dows(str(job.dow))
+    minute, hour, dows = local.split(":")
+    return int(minute), int(hour), parse_dows(dows)
+
+
+def get_local_expression(job):
+    """
+    Get the cron expression of an alarm in the timezone of its owner
+    """
+    if "tz" not in get_job_info(job):
+        return str(job.slices)
+    minute, hour, dows = get_local_schedule(job)
+    return " ".join([str(minute), str(hour), "*", "*", format_dows(dows)])
+
+
+def short_description(job, use_24hour_time_format=True):
+    replace_list = [["Sunday", "Sun"],
+                    ["Monday", "Mon"],
+                    ["Tuesday", "Tue"],
+                    ["Wednesday", "Wed"],
+                    ["Thursday", "Thr"],
+                    ["Friday", "Fri"],
+                    ["Saturday", "Sat"],
+                    [" through ", "-"],
+                    ["At", ""]]
+
+    description = ExpressionDescriptor(get_local_expression(job),
+                                       use_24hour_time_format=use_24hour_time_format).get_description()
+    for r in replace_list:
+        description = description.replace(r[0], r[1])
+
+    tz = get_job_info(job).get("tz")
+    if tz is not None:
+        description += " " + tz
+    return description.strip()
+
+
+def alarm_info(minute, hour, dows, owner=None, timezone=None):
+    """
+    Get the comment fields of an alarm
+    """
+    info = {"owner": owner, "tz": timezone}
+    if owner is not None or timezone is not None:
+        info["local"] = ":".join([str(minute), str(hour), format_dows(dows)])
+    return info
+
+
+def apply_schedule(job, minute, hour, dows):
+    job.minute.clear()
+    job.minute.on(minute)
+    job.hour.clear()
+    job.hour.on(hour)
+    job.dow.clear()
+    if dows is not None:
+        job.dow.on(*dows)
+    return
+
+
+def get_cron_jobs(cron_id):
+    """
+    Get the CronJobs of cron_id shared by the bot and the webserver in this process
+    """
+    with _instances_lock:
+        if cron_id not in _instances:
+            _instances[cron_id] = CronJobs(cron_id)
+        return _instances[cron_id]
+
+
+def register_cron_jobs(crontab):
+    """
+    Make get_cron_jobs return crontab for its cron id, used to share a CronJobs subclass in this process
+    """
+    with _instances_lock:
+        _instances[crontab.cron_id] = crontab
+    return
+
+
+class CronJobs:
+    def __init__(self, cron_id, user=True, tabfile=None):
+        """
+        :param cron_id: Marks the jobs this instance manages
+        :param user: The user whose crontab to use
+        :param tabfile: Use a crontab file instead of the user's crontab, cron does not run it
+        """
+        if " " in cron_id:
+            raise CronJobsError("Cron ID must not contain spaces")
+
+        self.cron_id = cron_id
+        self.user = user
+        self.tabfile = tabfile
+        if tabfile is None:
+            self.cron = CronTab(user=user)
+        else:
+            if not os.path.isfile(tabfile):
+                open(tabfile, "a").close()
+            self.cron = CronTab(tabfile=tabfile)
+        self.read_at = time.time()
+        self.read_stamp = self._stamp()
+        self.fire_times = FireTimeTable()
+        self.next_sync = 0
+        self.lock = threading.RLock()
+
+    def _stamp(self):
+        if self.tabfile is None:
+            return None
+        try:
+            stat = os.stat(self.tabfile)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self, force=False):
+        """
+        Read the crontab again if another process may have changed it
+
+        :param force: Read it even if it looks unchanged, done before every change
+        :return: True if the alarms changed
+        """
+        with self.lock:
+            if not force:
+                if self.tabfile is not None and self._stamp() == self.read_stamp:
+                    return False
+                if self.tabfile is None and time.time() < self.read_at + REFRESH_SECONDS:
+                    return False
+            before = self.cron.render()
+            self.cron.read(self.tabfile)
+            self.read_at = time.time()
+            self.read_stamp = self._stamp()
+            changed = self.cron.render() != before
+        if changed:
+            events.publish(events.ALARMS_CHANGED, cron_id=self.cron_id)
+        return changed
+
+    def _find(self, job_id):
+        for job in self._jobs():
+            if get_job_id(job) == job_id:
+                return job
+        return None
+
+    def _write(self):
+        self.cron.write()
+        self.read_at = time.time()
+        self.read_stamp = self._stamp()
+        events.publish(events.ALARMS_CHANGED, cron_id=self.cron_id)
+        return
+
+    def _create_job(self, command, info={}, job_id=None):
+        if job_id is None:
+            job_id = get_id(self.get_ids())
+        return self.cron.new(command=with_alarm_id(command, job_id),
+                             comment=build_comment(self.cron_id, job_id, info))
+
+    def _apply_schedule(self, job, minute, hour, dows, timezone=None):
+        if timezone is not None:
+            minute, hour, dows = system_schedule(get_timezone(timezone), minute, hour, dows)
+        apply_schedule(job, minute, hour, dows)
+        return
+
+    def _add(self, command, hour, minute, dows, owner=None, timezone=None):
+        with self.lock:
+            self.refresh(force=True)
+            job = self._create_job(command, alarm_info(minute, hour, dows, owner, timezone))
+            self._apply_schedule(job, minute, hour, dows, timezone)
+            job.enable()
+            self._write()
+        return
+
+    def add_daily(self, command, hour, minute, owner=None, timezone=None):
+        self._add(command, hour, minute, None, owner, timezone)
+        return
+
+    def add_weekday(self, command, hour, minute, owner=None, timezone=None):
+        self._add(command, hour, minute, WEEKDAYS, owner, timezone)
+        return
+
+    def get_fire_times(self, job, now=None):
+        """
+        Get the cached upcoming UTC fire instants of a job
+        """
+        return self.fire_times.get(get_job_id(job), get_local_expression(job), get_job_info(job).get("tz"), now)
+
+    def _jobs(self):
+        self.refresh()
+        with self.lock:
+            return [job for job in self.cron if job.comment.split(" ")[0] == self.cron_id]
+
+    def job_fire_times(self):
+        """
+        Get the jobs with their next fire time, sorted by it
+
+        :return: A list of (job, timestamp) tuples
+        """
+        return_value = []
+        now = time.time()
+        for job in self._jobs():
+            return_value.append((job, self.get_fire_times(job, now)[0]))
+        return_value.sort(key=lambda job_time: job_time[1])
+        return return_value
+
+    def job_list(self):
+        return [job for job, _ in self.job_fire_times()]
+
+    def get_readable_jobs(self):
+        return_value = []
+        for job in self.job_list():
+            return_value.append(short_description(job))
+        return return_value
+
+    def get_ids(self):
+        return_value = []
+        for job in self._jobs():
+            return_value.append(get_job_id(job))
+        return return_value
+
+    def _current(self, job):
+        """
+        Read the crontab again and get the same alarm from it
+
+        :return: The job, None if another process removed it
+        """
+        self.refresh(force=True)
+        return self._find(get_job_id(job))
+
+    def disable(self, job):
+        with self.lock:
+            job = self._current(job)
+            if job is None:
+                return
+            job.enable(False)
+            self._write()
+        return
+
+    def enable(self, job):
+        with self.lock:
+            job = self._current(job)
+            if job is None:
+                return
+            job.enable(True)
+            self._write()
+        return
+
+    def remove(self, job):
+        with self.lock:
+            job_id = get_job_id(job)
+            job = self._current(job)
+            if job is not None:
+                self.cron.remove(job)
+                self._write()
+            self.fire_times.invalidate(job_id)
+        return
+
+    def import_jobs(self, specs, prune=False, remove=()):
+        """
+        Make the alarms match specs, with a single crontab write. Importing the same specs again changes nothing.
+
+        :param specs: A list of dicts with id, command, minute, hour, dows, owner, timezone and enabled
+        :param prune: Remove alarms that are not in specs
+        :param remove: Ids of alarms to remove
+        :return: A dict of added, updated, unchanged and removed alarm ids
+        """
+        summary = {"added": [], "updated": [], "unchanged": [], "removed": []}
+        with self.lock:
+            self.refresh(force=True)
+            existing = {get_job_id(job): job for job in self._jobs()}
+            for spec in specs:
+                info = alarm_info(spec["minute"], spec["hour"], spec["dows"], spec.get("owner"), spec.get("timezone"))
+                job = existing.get(spec["id"])
+                if job is None:
+                    job = self._create_job(spec["command"], info, spec["id"])
+                    before = None
+                else:
+                    before = (job.command, job.comment, str(job.slices), job.is_enabled())
+                    job.set_command(with_alarm_id(spec["command"], spec["id"]))
+                    job.set_comment(build_comment(self.cron_id, spec["id"], info))
+
+                self._apply_schedule(job, spec["minute"], spec["hour"], spec["dows"], spec.get("timezone"))
+                job.enable(spec["enabled"])
+
+                if before is None:
+                    summary["added"].append(spec["id"])
+                elif before != (job.command, job.comment, str(job.slices), job.is_enabled()):
+                    summary["updated"].append(spec["id"])
+                else:
+                    summary["unchanged"].append(spec["id"])
+
+            spec_ids = {spec["id"] for spec in specs}
+            for job_id, job in existing.items():
+                if job_id in remove or (prune and job_id not in spec_ids):
+                    self.cron.remove(job)
+                    summary["removed"].append(job_id)
+
+            if summary["added"] or summary["updated"] or summary["removed"]:
+                self._write()
+        return summary
+
+    def set_owner_timezone(self, owner, timezone):
+        """
+        Move the alarms of a user to a new timezone, keeping their local time
+
+        :param owner: telegram id of the user
+        :param timezone: name of the new timezone
+        """
+        with self.lock:
+            self.refresh(force=True)
+            for job in self._jobs():
+                info = get_job_info(job)
+                if info.get("owner") != str(owner):
+                    continue
+                info["tz"] = timezone
+                job.set_comment(build_comment(self.cron_id, get_job_id(job), info))
+            self.sync_timezones(force=True)
+        return
+
+    def sync_timezones(self, now=None, force=False):
+        """
+        Rewrite the device time of alarms in other timezones once a DST transition passed.
+        Cheap to call often, it does nothing until the next transition.
+
+        :param now: timestamp to sync at
+        :param force: sync even if no transition passed
+        :return: True if crontab was written
+        """
+        if now is None:
+            now = time.time()
+        if not force and now < self.next_sync:
+            return False
+
+        with self.lock:
+            self.refresh(force=True)
+            changed = False
+            next_sync = self.fire_times.next_transition(None, now)
+            for job in self._jobs():
+                tz = get_timezone(get_job_info(job).get("tz"))
+                if tz is None:
+                    continue
+                minute, hour, dows = get_local_schedule(job)
+                before = str(job.slices)
+                apply_schedule(job, *system_schedule(tz, minute, hour, dows, now))
+                if str(job.slices) != before:
+                    changed = True
+                next_sync = min(next_sync, self.fire_times.next_transition(tz, now))
+
+            if changed or force:
+                self._write()
+            self.next_sync = next_sync
+        return changed
@@ -1,18 +1,87 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, DateTime, Index, inspect
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+ROLES = ["guest", "user", "admin"]
+
 class TelegramUser(Base):
     __tablename__ = "telegram_users"
+    # Role filtered user list pages are read in id order
+    __table_args__ = (Index("ix_telegram_users_role_id", "role", "id"),)
     id = Column(Integer, primary_key=True)
-    name = Column(String(30))
+    name = Column(String(30), index=True)
     role = Column(String(10))
+    timezone = Column(String(64))
 
-    def __init__(self, id, name, role):
+    def __init__(self, id, name, role, timezone=None):
         self.id = id
         self.name = name
         self.role = role
+        self.timezone = timezone
 
     def __repr__(self):
         return "%id=s,role=%s,name=%s" % (self.id, self.role, self.name)
+
+
+class AlarmSound(Base):
+    __tablename__ = "alarm_sounds"
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, index=True)
+    name = Column(String(64))
+    digest = Column(String(64), index=True)
+    size = Column(Integer)
+
+    def __init__(self, owner_id, name, digest, size):
+        self.owner_id = owner_id
+        self.name = name
+        self.digest = digest
+        self.size = size
+
+    def __repr__(self):
+        return "id=%s,owner_id=%s,name=%s,digest=%s" % (self.id, self.owner_id, self.name, self.digest)
+
+
+class AlarmEvent(Base):
+    __tablename__ = "alarm_events"
+    id = Column(Integer, primary_key=True)
+    alarm_id = Column(String(8), index=True)
+    pid = Column(Integer)
+    sound = Column(String(255))
+    fired_at = Column(DateTime, index=True)
+    first_audio_at = Column(DateTime)
+    stopped_at = Column(DateTime)
+    stopped_by = Column(String(64))
+    latency_ms = Column(Integer)
+
+    def __repr__(self):
+        return "id=%s,alarm_id=%s,fired_at=%s,stopped_by=%s" % (self.id, self.alarm_id, self.fired_at, self.stopped_by)
+
+
+def upgrade_db(engine):
+    """
+    Add columns and indexes that were added to existing tables after they were created
+
+    :param engine: engine of the database to upgrade
+    """
+    inspector = inspect(engine)
+    columns = [column["name"] for column in inspector.get_columns(TelegramUser.__tablename__)]
+    if "timezone" not in columns:
+        engine.execute("ALTER TABLE " + TelegramUser.__tablename__ + " ADD COLUMN timezone VARCHAR(64)")
+
+    indexes = [index["name"] for index in inspector.get_indexes(TelegramUser.__tablename__)]
+    for index in TelegramUser.__table__.indexes:
+        if index.name not in indexes:
+            index.create(engine)
+    return
+
+
+def create_tables(engine):
+    """
+    Create the tables the bot uses and upgrade existing ones
+
+    :param engine: engine of the database
+    """
+    Base.metadata.create_all(engine)
+    upgrade_db(engine)
+    return
@@ -0,0 +1,153 @@
+"""
+In process events shared by the bot and the webserver
+
+Every published event bumps a data version, that the webserver uses to tell if a cached page is still fresh.
+The version is kept in a file, so it is shared with the other processes of the device and survives restarts,
+a change made by the bot shows up in a webserver running as its own process.
+"""
+import os
+import fcntl
+import queue
+import threading
+import traceback
+
+USER_JOINED = "user_joined"
+ROLE_CHANGED = "role_changed"
+ALARMS_CHANGED = "alarms_changed"
+ALARM_FIRED = "alarm_fired"
+ALARM_STOPPED = "alarm_stopped"
+
+# Events a Listener keeps for a slow reader before it gives up and asks it to resync
+LISTENER_QUEUE_SIZE = 100
+
+VERSION_PATH = os.path.expanduser(os.path.join("~", ".alarmbot", "data_version"))
+
+_lock = threading.Lock()
+# Only used when the version file can not be used, starts at a random value so a restart doesn't repeat old versions
+_version = int.from_bytes(os.urandom(4), "big")
+_subscribers = []
+
+
+def shared_version(bump=False):
+    """
+    Read or bump the data version shared by all processes
+
+    :param bump: Increment it
+    :return: The version, None if the version file can not be used
+    """
+    try:
+        if bump:
+            os.makedirs(os.path.dirname(VERSION_PATH), exist_ok=True)
+        fd = os.open(VERSION_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if bump else fcntl.LOCK_SH)
+        try:
+            value = int(os.read(fd, 32) or 0)
+        except ValueError:
+            value = 0
+        if bump:
+            value += 1
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(value).encode())
+        return value
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def version():
+    shared = shared_version()
+    return _version if shared is None else shared
+
+
+def subscribe(callback):
+    """
+    Call callback(kind, data, version) on every published event, version is the data version it bumped to
+    """
+    with _lock:
+        _subscribers.append(callback)
+    return
+
+
+def unsubscribe(callback):
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+    return
+
+
+def publish(kind, **data):
+    """
+    Publish an event and bump the data version
+
+    :param kind: One of the event kinds in this module
+    :param data: Event data, must be json serializable
+    """
+    global _version
+    shared = shared_version(bump=True)
+    with _lock:
+        _version = _version + 1 if shared is None else shared
+        published_version = _version
+        subscribers = list(_subscribers)
+
+    # The change is already made when it is published, a failing subscriber must not fail the publisher
+    for callback in subscribers:
+        try:
+            callback(kind, data, published_version)
+        except Exception:
+            print(str(traceback.format_exc()))
+    return
+
+
+class Listener:
+    """
+    Collects published events in a bounded queue, for a reader in another thread
+
+    Publishing never blocks on a listener. If the reader falls behind the queue is dropped,
+    and the reader is told to resync from scratch.
+    """
+
+    def __init__(self, size=LISTENER_QUEUE_SIZE):
+        self.events = queue.Queue(maxsize=size)
+        self.overflowed = False
+        subscribe(self.on_event)
+
+    def on_event(self, kind, data, version):
+        try:
+            self.events.put_nowait((version, kind, data))
+        except queue.Full:
+            self.overflowed = True
+            while not self.events.empty():
+                try:
+                    self.events.get_nowait()
+                except queue.Empty:
+                    break
+        return
+
+    def get(self, timeout):
+        """
+        Wait for the next event
+
+        :param timeout: Max seconds to wait
+        :return: (version, kind, data), or None if nothing was published in time
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def take_overflow(self):
+        """
+        :return: True if events were dropped since the last call
+        """
+        overflowed = self.overflowed
+        self.overflowed = False
+        return overflowed
+
+    def close(self):
+        unsubscribe(self.on_event)
+        return
@@ -0,0 +1,357 @@
+"""
+Control a fleet of alarm devices that run agent.py, from a single coordinator bot
+
+The coordinator keeps the alarms in its own crontab file, and sends every change to all devices.
+Commands to a device wait in an outbox that is kept on disk, and are sent in batches over one
+persistent connection per device. While a device is offline its outbox grows, and is replayed in
+order once it is back. Every command is idempotent, so a batch that may have been applied before
+the connection broke is simply sent again.
+"""
+import os
+import json
+import time
+import socket
+import threading
+from collections import OrderedDict
+from agent import write_message, read_message, read_line, weak_secret, ProtocolError, TO_AGENT, TO_COORDINATOR, \
+    DEFAULT_PORT
+from common import ensure_dir
+from cron_jobs import CronJobs
+from alarm_sets import export_alarms
+
+OUTBOX_DIR = os.path.expanduser(os.path.join("~", ".alarmbot", "fleet"))
+TABFILE = os.path.expanduser(os.path.join("~", ".alarmbot", "fleet.tab"))
+
+# How long to wait for more commands before sending a batch
+DEFAULT_BATCH_MS = 200
+MAX_BATCH = 100
+
+DEFAULT_RETRY_SECONDS = 30
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 10
+
+# A stop that could not be delivered in time is dropped, a late stop would cut the next alarm short
+STOP_TTL = 60
+
+
+class FleetError(Exception):
+    def __init__(self, message=""):
+        self.message = message
+
+
+def parse_devices(devices):
+    """
+    Parse the devices of the fleet config
+
+    :param devices: A string like "kitchen@192.168.1.5:7010, bedroom@192.168.1.6", the port is optional
+    :return: A list of (name, host, port)
+    """
+    return_value = []
+    for device in devices.split(","):
+        device = device.strip()
+        if device == "":
+            continue
+        name, address = device.split("@")
+        host, _, port = address.partition(":")
+        return_value.append((name, host, int(port) if port else DEFAULT_PORT))
+    return return_value
+
+
+class AgentConnection:
+    """
+    A persistent connection to an agent, reconnected on the next request after it breaks
+    """
+
+    def __init__(self, host, port, secret):
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.sock = None
+        self.f = None
+        self.challenge = None
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        self.sock.settimeout(REQUEST_TIMEOUT)
+        self.f = self.sock.makefile("rwb")
+        hello = read_line(self.f)
+        if not isinstance(hello, dict) or "challenge" not in hello:
+            raise ProtocolError("Agent did not send a challenge")
+        self.challenge = str(hello["challenge"])
+        self.seq = 0
+        return
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.f = None
+        return
+
+    def request(self, commands):
+        """
+        Send a batch of commands
+
+        :return: A list with the result of every command
+        :raises FleetError: if the agent could not be reached or answered wrong
+        """
+        with self.lock:
+            # A kept connection may have been closed by an agent restart, retry once on a new one
+            attempts = 1 if self.sock is None else 2
+            for attempt in range(attempts):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    write_message(self.f, self.secret, self.challenge, TO_AGENT, self.seq, commands)
+                    results = read_message(self.f, self.secret, self.challenge, TO_COORDINATOR, self.seq)
+                    if results is None:
+                        raise ProtocolError("Agent closed the connection")
+                    self.seq += 1
+                    return results
+                except (OSError, ProtocolError) as e:
+                    self.close()
+                    if attempt == attempts - 1:
+                        raise FleetError(getattr(e, "message", None) or str(e))
+
+
+class Device(threading.Thread):
+    """
+    Delivers the outbox of one device in batches
+    """
+
+    def __init__(self, name, connection, outbox_path, batch_ms=DEFAULT_BATCH_MS, retry_seconds=DEFAULT_RETRY_SECONDS):
+        super(Device, self).__init__()
+        self.daemon = True
+        self.name = name
+        self.connection = connection
+        self.outbox_path = outbox_path
+        self.batch_ms = batch_ms
+        self.retry_seconds = retry_seconds
+        self.online = False
+        self.last_seen = None
+        self.last_error = None
+        self.condition = threading.Condition()
+        self.wake = threading.Event()
+        self.closing = False
+
+        # Queued commands as (command, queued at)
+        self.outbox = []
+        self.new = not os.path.isfile(outbox_path)
+        if not self.new:
+            with open(outbox_path) as f:
+                self.outbox = [tuple(entry) for entry in json.load(f)]
+
+    def save_outbox(self):
+        temp_path = self.outbox_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.outbox, f)
+        os.replace(temp_path, self.outbox_path)
+        return
+
+    def queue(self, command):
+        with self.condition:
+            self.outbox.append((command, time.time()))
+            self.save_outbox()
+            self.condition.notify()
+        return
+
+    def request(self, commands):
+        """
+        Send commands now, bypassing the outbox
+
+        :raises FleetError: if the device is offline
+        """
+        try:
+            results = self.connection.request(commands)
+        except FleetError as e:
+            self.set_online(False, e.message)
+            raise
+        self.set_online(True)
+        return results
+
+    def set_online(self, online, error=None):
+        if online and not self.online:
+            print("Fleet device " + self.name + " is online")
+        elif not online and self.online:
+            print("Fleet device " + self.name + " is offline: " + str(error))
+        self.online = online
+        self.last_error = error
+        if online:
+            self.last_seen = time.time()
+        return
+
+    def next_batch(self):
+        """
+        Wait for commands to send, and drop stops that are too old to send
+
+        :return: The number of outbox entries in the batch, and the batch
+        """
+        with self.condition:
+            while len(self.outbox) == 0 and not self.closing:
+                self.condition.wait()
+            # Give a burst of changes time to arrive, a stop goes out right away
+            deadline = time.time() + self.batch_ms / 1000.0
+            while not self.closing and time.time() < deadline \
+                    and not any(command["op"] == "stop" for command, _ in self.outbox):
+                self.condition.wait(deadline - time.time())
+            entries = self.outbox[:MAX_BATCH]
+
+        now = time.time()
+        commands = [command for command, queued_at in entries
+                    if command["op"] != "stop" or now - queued_at < STOP_TTL]
+        return len(entries), commands
+
+    def run(self):
+        while not self.closing:
+            count, commands = self.next_batch()
+            if count == 0:
+                continue
+            try:
+                results = self.request(commands) if len(commands) > 0 else []
+            except FleetError:
+                self.wake.wait(self.retry_seconds)
+                self.wake.clear()
+                continue
+
+            for command, result in zip(commands, results):
+                if not result.get("ok"):
+                    print("Fleet device " + self.name + " rejected " + json.dumps(command) + ": " +
+                          str(result.get("error")))
+            with self.condition:
+                del self.outbox[:count]
+                self.save_outbox()
+        return
+
+    def retry(self):
+        """
+        Send the outbox now instead of waiting for the next retry
+        """
+        self.wake.set()
+        return
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.wake.set()
+        self.connection.close()
+        return
+
+    def status(self):
+        return {"name": self.name, "online": self.online, "pending": len(self.outbox),
+                "last_seen": self.last_seen, "error": self.last_error}
+
+
+class Fleet:
+    def __init__(self, settings, outbox_dir=OUTBOX_DIR):
+        """
+        :param settings: The [fleet] config section
+        :param outbox_dir: Folder the outboxes of devices are kept in
+        :raises FleetError: if the secret is missing or still the one from the example config
+        """
+        if weak_secret(settings.get("secret")):
+            raise FleetError("Set a [fleet] secret of your own, the same on the coordinator and every device")
+        ensure_dir(outbox_dir)
+        self.devices = OrderedDict()
+        batch_ms = int(settings.get("batch_ms", DEFAULT_BATCH_MS))
+        retry_seconds = int(settings.get("retry_seconds", DEFAULT_RETRY_SECONDS))
+        for name, host, port in parse_devices(settings.get("devices", "")):
+            connection = AgentConnection(host, port, settings["secret"].strip())
+            self.devices[name] = Device(name, connection, os.path.join(outbox_dir, name + ".json"),
+                                        batch_ms, retry_seconds)
+
+    def start(self):
+        for device in self.devices.values():
+            device.start()
+        return
+
+    def apply_settings(self, settings):
+        """
+        Apply changed batch_ms and retry_seconds from the [fleet] config section
+        """
+        fleet_settings = settings.get("fleet", {})
+        for device in self.devices.values():
+            device.batch_ms = int(fleet_settings.get("batch_ms", DEFAULT_BATCH_MS))
+            device.retry_seconds = int(fleet_settings.get("retry_seconds", DEFAULT_RETRY_SECONDS))
+        return
+
+    def send(self, command):
+        """
+        Queue a command to every device
+        """
+        for device in self.devices.values():
+            device.queue(command)
+        return
+
+    def stop(self, stopped_by):
+        self.send({"op": "stop", "stopped_by": stopped_by})
+        return
+
+    def list_alarms(self):
+        """
+        Get the alarms every device has now
+
+        :return: A dict of device name to a list of alarms, or to a FleetError if it is offline
+        """
+        return_value = {}
+        for name, device in self.devices.items():
+            try:
+                return_value[name] = device.request([{"op": "list"}])[0]["alarms"]
+            except FleetError as e:
+                return_value[name] = e
+        return return_value
+
+    def status(self):
+        return [device.status() for device in self.devices.values()]
+
+    def close(self):
+        for device in self.devices.values():
+            device.close()
+        return
+
+
+class FleetCronJobs(CronJobs):
+    """
+    CronJobs that sends every change of its alarms to the fleet
+    """
+
+    def __init__(self, cron_id, fleet, tabfile=TABFILE):
+        """
+        :param cron_id: Marks the jobs this instance manages
+        :param fleet: The Fleet to send changes to
+        :param tabfile: Crontab file the coordinator keeps the alarms in, cron does not run it
+        """
+        super(FleetCronJobs, self).__init__(cron_id, tabfile=tabfile)
+        self.fleet = fleet
+        self.alarms = self.export()
+
+        # Devices seen for the first time get all alarms
+        for device in fleet.devices.values():
+            if device.new:
+                for alarm in self.alarms.values():
+                    device.queue({"op": "add", "alarm": alarm})
+
+    def export(self):
+        return {alarm["id"]: alarm for alarm in export_alarms(self)["alarms"]}
+
+    def _write(self):
+        super(FleetCronJobs, self)._write()
+        alarms = self.export()
+        for alarm_id, alarm in alarms.items():
+            before = self.alarms.get(alarm_id)
+            if before == alarm:
+                continue
+            if before is not None and dict(before, enabled=alarm["enabled"]) == alarm:
+                self.fleet.send({"op": "enable" if alarm["enabled"] else "disable", "id": alarm_id})
+            else:
+                self.fleet.send({"op": "add", "alarm": alarm})
+        for alarm_id in self.alarms:
+            if alarm_id not in alarms:
+                self.fleet.send({"op": "remove", "id": alarm_id})
+        self.alarms = alarms
+        return
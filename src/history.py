@@ -0,0 +1,226 @@
+"""
+Record when alarms fired, started to make sound and were stopped
+
+Events are queued and inserted in batches from a background thread, so recording never blocks playback.
+When the database can not be reached they are appended to a local file, and inserted once it is back.
+Every alarm process has its own writer, a writer claims the spill file with a rename before inserting it,
+so two writers never insert the same events.
+"""
+import os
+import json
+import time
+import fcntl
+import queue
+import threading
+import traceback
+from datetime import datetime
+
+SPILL_PATH = os.path.expanduser(os.path.join("~", ".alarmbot", "history.jsonl"))
+
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 2
+QUEUE_SIZE = 1000
+
+# Columns of AlarmEvent that hold timestamps, spilled and queued as floats
+TIME_COLUMNS = ["fired_at", "first_audio_at", "stopped_at"]
+
+
+def to_row(event):
+    """
+    Convert a queued event to an AlarmEvent row
+    """
+    row = dict(event)
+    for column in TIME_COLUMNS:
+        if row.get(column) is not None:
+            row[column] = datetime.fromtimestamp(row[column])
+    return row
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class HistoryWriter(threading.Thread):
+    """
+    Batches AlarmEvent inserts in a background thread, spills to a file when the database is down
+    """
+
+    def __init__(self, uri, spill_path=SPILL_PATH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        :param uri: database uri
+        :param spill_path: append only file for events that could not be inserted
+        :param batch_size: Max events per insert
+        :param flush_interval: Max seconds an event waits in the queue
+        """
+        super(HistoryWriter, self).__init__()
+        self.daemon = True
+        self.uri = uri
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events = queue.Queue(maxsize=QUEUE_SIZE)
+        self.closing = threading.Event()
+        self.spill_lock = threading.Lock()
+        self.engine = None
+
+    def record(self, **event):
+        """
+        Queue an event, never blocks
+
+        :param event: AlarmEvent columns, times as timestamps
+        """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.spill([event])
+        return
+
+    def spill(self, events):
+        with self.spill_lock:
+            while True:
+                with open(self.spill_path, "a") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    # Another writer may have claimed the file between open and flock
+                    try:
+                        claimed = os.fstat(f.fileno()).st_ino != os.stat(self.spill_path).st_ino
+                    except FileNotFoundError:
+                        claimed = True
+                    if claimed:
+                        continue
+                    for event in events:
+                        f.write(json.dumps(event) + "\n")
+                    return
+
+    def insert(self, events):
+        # Imported here so starting the writer does not delay the caller
+        from sqlalchemy import create_engine
+        from database import AlarmEvent
+
+        if self.engine is None:
+            self.engine = create_engine(self.uri)
+        with self.engine.begin() as connection:
+            connection.execute(AlarmEvent.__table__.insert(), [to_row(event) for event in events])
+        return
+
+    def claim_spilled(self):
+        """
+        Take the spill file, and files claimed by writers that died while replaying them
+
+        :return: Paths of the claimed files, no other writer will read them
+        """
+        directory, name = os.path.split(self.spill_path)
+        paths = [self.spill_path]
+        for file_name in os.listdir(directory):
+            if not file_name.startswith(name + ".replay"):
+                continue
+            try:
+                pid = int(file_name[len(name + ".replay-"):].split("-")[0])
+            except ValueError:
+                # Claimed before claims had the pid in their name
+                pid = None
+            if pid is not None and pid != os.getpid() and pid_alive(pid):
+                continue
+            paths.append(os.path.join(directory, file_name))
+
+        claimed = []
+        with self.spill_lock:
+            for path in paths:
+                claim_path = self.spill_path + ".replay-" + str(os.getpid()) + "-" + os.urandom(4).hex()
+                try:
+                    os.rename(path, claim_path)
+                except FileNotFoundError:
+                    continue
+                claimed.append(claim_path)
+        return claimed
+
+    def replay_spilled(self):
+        """
+        Insert events that were spilled while the database was down
+
+        Events that could not be inserted are spilled again.
+        """
+        if not os.path.isdir(os.path.dirname(self.spill_path)):
+            return
+        for claim_path in self.claim_spilled():
+            events = []
+            bad_lines = []
+            with open(claim_path, errors="replace") as f:
+                # Wait for a writer that appended just before the file was claimed
+                fcntl.flock(f, fcntl.LOCK_SH)
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        event = None
+                    if isinstance(event, dict):
+                        events.append(event)
+                    else:
+                        bad_lines.append(line if line.endswith("\n") else line + "\n")
+            if len(bad_lines) > 0:
+                # Like a line cut short when a process was killed while spilling, kept aside for a look
+                print("Skipping " + str(len(bad_lines)) + " damaged alarm history lines, moved to " +
+                      self.spill_path + ".bad")
+                with open(self.spill_path + ".bad", "a") as f:
+                    f.writelines(bad_lines)
+            try:
+                for i in range(0, len(events), self.batch_size):
+                    self.insert(events[i:i + self.batch_size])
+            except Exception:
+                self.spill(events[i:])
+                os.unlink(claim_path)
+                raise
+            os.unlink(claim_path)
+        return
+
+    def flush(self, events):
+        try:
+            self.insert(events)
+        except Exception as e:
+            print("Could not record alarm history, keeping it in " + self.spill_path + ": " + str(e))
+            self.spill(events)
+            return
+
+        try:
+            self.replay_spilled()
+        except Exception:
+            print(str(traceback.format_exc()))
+        return
+
+    def run(self):
+        while not (self.closing.is_set() and self.events.empty()):
+            try:
+                events = [self.events.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + self.flush_interval
+            while len(events) < self.batch_size and not self.closing.is_set():
+                try:
+                    events.append(self.events.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            while len(events) < self.batch_size and not self.events.empty():
+                events.append(self.events.get_nowait())
+            self.flush(events)
+        return
+
+    def close(self, timeout=10):
+        """
+        Flush queued events and stop, events still queued after timeout are spilled
+        """
+        self.closing.set()
+        self.join(timeout)
+        if self.is_alive():
+            remaining = []
+            while not self.events.empty():
+                remaining.append(self.events.get_nowait())
+            if len(remaining) > 0:
+                self.spill(remaining)
+        return
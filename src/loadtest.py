@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Load test the admin webserver against a throwaway sqlite database
+
+Starts the webserver in this process on a free local port, seeds telegram users, and runs concurrent
+clients that log in and then load the users page, page through /api/users and change roles.
+Prints throughput, latency percentiles and database connection counts. Runs offline, so it can be
+used in CI, with --max-p99-ms to fail when a route got slower.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+from http.cookiejar import CookieJar
+from urllib.request import build_opener, HTTPCookieProcessor, Request
+from urllib.parse import urlencode
+from urllib.error import HTTPError, URLError
+
+DEFAULT_USERS = 5000
+DEFAULT_CLIENTS = 8
+DEFAULT_REQUESTS = 200
+PASSWORD = "loadtest"
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+CONFIG = """[webserver]
+enabled=on
+port=0
+init_password={password}
+
+[db]
+uri=sqlite:///{db_path}
+"""
+
+
+def percentile(values, percent):
+    """
+    :param values: A sorted list
+    :param percent: 0 to 100
+    :return: The value below which percent of values are, nearest rank
+    """
+    if len(values) == 0:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(percent / 100.0 * len(values))) - 1))
+    return values[rank]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, route, seconds, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies.setdefault(route, []).append(seconds)
+            else:
+                self.errors.setdefault(route, []).append(error)
+        return
+
+    def summary(self, elapsed):
+        return_value = {}
+        for route in sorted(set(self.latencies.keys()) | set(self.errors.keys())):
+            latencies = sorted(self.latencies.get(route, []))
+            return_value[route] = {"requests": len(latencies),
+                                   "errors": len(self.errors.get(route, [])),
+                                   "per_second": len(latencies) / elapsed if elapsed > 0 else 0,
+                                   "p50_ms": ms(percentile(latencies, 50)),
+                                   "p90_ms": ms(percentile(latencies, 90)),
+                                   "p99_ms": ms(percentile(latencies, 99))}
+        return return_value
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class Client:
+    """
+    A browser session, with its own cookies
+    """
+
+    def __init__(self, base_url, stats):
+        self.base_url = base_url
+        self.stats = stats
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def request(self, route, path, data=None, headers={}):
+        request = Request(self.base_url + path, data=data, headers=headers)
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                body = response.read()
+        except (HTTPError, URLError, OSError) as e:
+            self.stats.add(route, time.perf_counter() - start, str(e))
+            return None
+        self.stats.add(route, time.perf_counter() - start)
+        return body
+
+    def login(self):
+        page = self.request("GET /login", "/login")
+        if page is None:
+            return False
+        match = CSRF_TOKEN.search(page.decode())
+        form = {"username": "admin", "password": PASSWORD}
+        if match is not None:
+            form["csrf_token"] = match.group(1)
+        # A successful login redirects to /, which the opener follows and is counted in the login time
+        return self.request("POST /login", "/login", urlencode(form).encode()) is not None
+
+    def run(self, requests, user_count, roles):
+        if not self.login():
+            return
+        for _ in range(requests):
+            choice = random.random()
+            if choice < 0.3:
+                self.request("GET /", "/", headers={"Accept-Encoding": "gzip"})
+            elif choice < 0.7:
+                query = {"limit": 50, "after": random.randint(0, user_count)}
+                self.request("GET /api/users", "/api/users?" + urlencode(query), headers={"Accept-Encoding": "gzip"})
+            else:
+                change = {"user": random.randint(1, user_count), "role": random.choice(roles)}
+                self.request("POST /update_role", "/update_role", json.dumps(change).encode(),
+                             {"Content-Type": "application/json"})
+        return
+
+
+def seed_users(engine, count):
+    from database import TelegramUser, ROLES
+    rows = [{"id": i, "name": "user%d" % i, "role": ROLES[i % len(ROLES)]} for i in range(1, count + 1)]
+    with engine.begin() as connection:
+        connection.execute(TelegramUser.__table__.insert(), rows)
+    return
+
+
+class ConnectionCounter:
+    """
+    Counts new database connections and pool checkouts of an engine
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.lock = threading.Lock()
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checked_out -= 1
+
+    def summary(self):
+        return {"connects": self.connects, "checkouts": self.checkouts, "max_checked_out": self.max_checked_out,
+                "pool": self.engine.pool.__class__.__name__}
+
+
+def run_load_test(users=DEFAULT_USERS, clients=DEFAULT_CLIENTS, requests=DEFAULT_REQUESTS, work_dir=None):
+    """
+    Run the load test in this process, before anything in it read the config
+
+    :param users: Number of telegram users to seed
+    :param clients: Number of concurrent clients
+    :param requests: Requests per client after logging in
+    :param work_dir: Folder for the config and database, a temporary one by default
+    :return: A dict with the results
+    """
+    own_work_dir = work_dir is None
+    if own_work_dir:
+        work_dir = tempfile.mkdtemp(prefix="alarmbot-loadtest-")
+    config_path = os.path.join(work_dir, "config.ini")
+    with open(config_path, "w") as f:
+        f.write(CONFIG.format(password=PASSWORD, db_path=os.path.join(work_dir, "loadtest.db")))
+
+    # The webserver reads the config when it is imported
+    os.environ["ALARMBOT_CONFIG"] = config_path
+    import common
+    common.CONFIG_PATH = config_path
+    from common import get_config, get_uri
+    from database import ROLES
+    from sqlalchemy import create_engine
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    from webserver import webserver
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    uri = get_uri(get_config())
+    webserver.init_db(uri)
+    seed_users(create_engine(uri), users)
+
+    with webserver.app.app_context():
+        counter = ConnectionCounter(webserver.db.engine)
+
+    server = make_server("127.0.0.1", 0, webserver.app, threaded=True, request_handler=QuietRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    base_url = "http://127.0.0.1:" + str(server.server_port)
+
+    stats = Stats()
+    threads = [threading.Thread(target=Client(base_url, stats).run, args=(requests, users, ROLES))
+               for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    if own_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    routes = stats.summary(elapsed)
+    total = sum(route["requests"] for route in routes.values())
+    return {"users": users, "clients": clients, "seconds": round(elapsed, 2),
+            "requests": total, "errors": sum(route["errors"] for route in routes.values()),
+            "per_second": round(total / elapsed, 1) if elapsed > 0 else 0,
+            "routes": routes, "db": counter.summary()}
+
+
+def format_results(results):
+    lines = ["%d requests from %d clients in %.2fs, %.1f requests/s, %d errors" %
+             (results["requests"], results["clients"], results["seconds"], results["per_second"], results["errors"]),
+             "",
+             "%-18s %8s %7s %8s %9s %9s %9s" % ("route", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms")]
+    for route, summary in results["routes"].items():
+        lines.append("%-18s %8d %7d %8.1f %9s %9s %9s" % (route, summary["requests"], summary["errors"],
+                                                          summary["per_second"], summary["p50_ms"],
+                                                          summary["p90_ms"], summary["p99_ms"]))
+    db = results["db"]
+    lines += ["", "Database (%s): %d connections opened, %d checkouts, at most %d in use" %
+              (db["pool"], db["connects"], db["checkouts"], db["max_checked_out"])]
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(add_help=True, description="Load test the admin webserver against sqlite")
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS, help='Telegram users to seed')
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='Requests per client after login')
+    parser.add_argument('--json', action='store_true', help='Print the results as json')
+    parser.add_argument('--max-p99-ms', type=float, default=None,
+                        help='Exit with an error if the p99 latency of any route is higher')
+    args = parser.parse_args()
+
+    results = run_load_test(args.users, args.clients, args.requests)
+    print(json.dumps(results, indent=2) if args.json else format_results(results))
+
+    failed = results["errors"] > 0
+    if args.max_p99_ms is not None:
+        for route, summary in results["routes"].items():
+            if summary["p99_ms"] is not None and summary["p99_ms"] > args.max_p99_ms:
+                print("p99 of " + route + " is over " + str(args.max_p99_ms) + "ms")
+                failed = True
+    sys.exit(1 if failed else 0)
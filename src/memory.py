@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Report the memory footprint of the bot process
+
+RSS is read from /proc, allocation sites come from tracemalloc when it is enabled in the config.
+Run it as a script to check a running bot against a memory budget, or without a pid to load the bot
+modules in the script itself, put them through typical work and check that against the budget.
+"""
+import os
+import gc
+import sys
+import shutil
+import tempfile
+import signal
+import resource
+import tracemalloc
+
+MB = 1024 * 1024
+
+DEFAULT_SETTINGS = {
+    "tracemalloc": "off",
+    "tracemalloc_frames": "1",
+    "rss_budget_mb": "120",
+}
+
+
+def rss_bytes(pid="self"):
+    """
+    Get the resident set size of a process
+
+    :param pid: pid of the process, defaults to this process
+    :return: RSS in bytes
+    """
+    try:
+        with open(os.path.join("/proc", str(pid), "statm")) as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        if pid != "self":
+            raise
+        # No /proc, use the peak RSS which is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_tracing(settings):
+    """
+    Start or stop tracemalloc as set in the [memory] section of the config
+    """
+    memory_settings = DEFAULT_SETTINGS.copy()
+    memory_settings.update(settings.get("memory", {}))
+    frames = int(memory_settings["tracemalloc_frames"])
+    if memory_settings["tracemalloc"] != "on":
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    elif not tracemalloc.is_tracing() or tracemalloc.get_traceback_limit() != frames:
+        tracemalloc.stop()
+        tracemalloc.start(frames)
+    return
+
+
+def top_allocations(limit=10):
+    """
+    Get the source lines that allocated the most memory still in use
+
+    :param limit: Number of lines to return
+    :return: A list of dicts, empty if tracemalloc is not tracing
+    """
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    return_value = []
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        return_value.append({"file": frame.filename, "line": frame.lineno, "size": stat.size, "count": stat.count})
+    return return_value
+
+
+def report(limit=10):
+    """
+    Get a memory report of this process
+
+    :param limit: Number of allocation sites to include
+    :return: A dict that can be dumped as json
+    """
+    return_value = {"rss": rss_bytes(), "tracemalloc": None}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        return_value["tracemalloc"] = {"current": current, "peak": peak, "top": top_allocations(limit)}
+    return return_value
+
+
+def format_report(memory_report):
+    text = "RSS: %.1fMB\n" % (memory_report["rss"] / MB)
+    traced = memory_report["tracemalloc"]
+    if traced is None:
+        return text + "tracemalloc is off, set tracemalloc=on in the [memory] section of the config\n"
+
+    text += "Traced: %.1fMB, peak %.1fMB\n" % (traced["current"] / MB, traced["peak"] / MB)
+    for site in traced["top"]:
+        text += "%8.1fKB %6d blocks %s:%d\n" % (site["size"] / 1024, site["count"], site["file"], site["line"])
+    return text
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    """
+    Print a memory report to stdout when the process gets signum
+    """
+    def handler(signum, frame):
+        print(format_report(report()))
+        sys.stdout.flush()
+
+    signal.signal(signum, handler)
+    return
+
+
+def check_budget(budget_mb, pid="self"):
+    """
+    Check the RSS of a process against a budget
+
+    :param budget_mb: Budget in megabytes
+    :param pid: pid of the process, defaults to this process
+    :return: (True if within budget, RSS in bytes)
+    """
+    rss = rss_bytes(pid)
+    return rss <= budget_mb * MB, rss
+
+
+def exercise_bot(work_dir, webserver=True, users=1000, alarms=50):
+    """
+    Load the bot modules in this process and put them through typical work, without telegram or cron
+
+    :param work_dir: Folder for the databases, config and crontab file
+    :param webserver: Also serve requests from the web interface, as the bot does by default
+    :param users: Number of telegram users to seed
+    :param alarms: Number of alarms to create
+    """
+    if webserver:
+        # Serves the web interface in this process against its own sqlite database
+        from loadtest import run_load_test
+        run_load_test(users, clients=2, requests=50, work_dir=work_dir)
+
+    from sqlalchemy import create_engine
+    from loadtest import seed_users
+    from database import create_tables
+    from alarm_bot import RoleCache
+    from cron_jobs import CronJobs
+    from timeline import Timeline, MAX_DAYS
+    from alarm_sets import export_alarms, import_alarms
+    from common import ALARM_COMMAND, DEFAULT_SOUND
+
+    engine = create_engine("sqlite:///" + os.path.join(work_dir, "bot.db"))
+    create_tables(engine)
+    seed_users(engine, users)
+    role_cache = RoleCache(engine)
+    for telegram_id in range(1, users + 1):
+        role_cache.get(telegram_id)
+
+    crontab = CronJobs("alarmbot", tabfile=os.path.join(work_dir, "alarms.tab"))
+    for i in range(alarms):
+        timezone = "Asia/Jerusalem" if i % 2 == 0 else None
+        if i % 3 == 0:
+            crontab.add_weekday(ALARM_COMMAND + " " + DEFAULT_SOUND, i % 24, i % 60, i + 1, timezone)
+        else:
+            crontab.add_daily(ALARM_COMMAND + " " + DEFAULT_SOUND, i % 24, i % 60, i + 1, timezone)
+    crontab.get_readable_jobs()
+    import_alarms(crontab, export_alarms(crontab))
+    Timeline(crontab).upcoming(MAX_DAYS)
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    from common import Config, CONFIG_PATH
+
+    parser = argparse.ArgumentParser(add_help=True,
+                                     description="Check that the bot stays within its memory budget")
+    parser.add_argument('pid', type=int, nargs="?", default=None,
+                        help='The pid of a running bot, without it the bot modules are loaded and exercised here')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Budget in MB, defaults to rss_budget_mb in the [memory] section of the config')
+    parser.add_argument('--no-webserver', action='store_true', help='Do not exercise the web interface')
+    args = parser.parse_args()
+
+    budget = args.budget
+    if budget is None:
+        # Parsed without get_config, which would keep it for the load test in exercise_bot
+        memory_settings = DEFAULT_SETTINGS.copy()
+        memory_settings.update(Config(CONFIG_PATH).get("memory", {}))
+        budget = float(memory_settings["rss_budget_mb"])
+
+    if args.pid is not None:
+        ok, rss = check_budget(budget, args.pid)
+        print("RSS of %d is %.1fMB, budget is %.1fMB" % (args.pid, rss / MB, budget))
+        sys.exit(0 if ok else 1)
+
+    work_dir = tempfile.mkdtemp(prefix="alarmbot-memory-")
+    try:
+        exercise_bot(work_dir, not args.no_webserver)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    gc.collect()
+    ok, rss = check_budget(budget)
+    print("RSS after exercising the bot is %.1fMB, budget is %.1fMB" % (rss / MB, budget))
+    sys.exit(0 if ok else 1)
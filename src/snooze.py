@@ -0,0 +1,127 @@
+"""
+Ring an alarm again a few minutes after it was snoozed
+
+Snoozes are one-shot timers on the bot job queue, not crontab lines, so snoozing costs no crontab
+write and leaves nothing to clean up. Pending snoozes are kept in a json file and scheduled again
+when the bot restarts.
+"""
+import os
+import json
+import math
+import time
+import threading
+from common import ensure_dir
+
+SNOOZE_PATH = os.path.expanduser(os.path.join("~", ".alarmbot", "snoozes.json"))
+
+DEFAULT_SNOOZE_MINUTES = 9
+
+
+def snooze_minutes(config):
+    """
+    :param config: The bot Config
+    :return: [alarm] snooze_minutes, at least 1
+    """
+    return max(1, config.get_int("alarm", "snooze_minutes", DEFAULT_SNOOZE_MINUTES))
+
+
+def valid_snooze(snooze):
+    """
+    Check a snooze read from the file has what start and run_snooze use
+    """
+    return isinstance(snooze, dict) and isinstance(snooze.get("sound"), str) and \
+        isinstance(snooze.get("fire_at"), (int, float)) and not isinstance(snooze["fire_at"], bool) and \
+        (snooze.get("alarm") is None or isinstance(snooze["alarm"], str))
+
+
+# A snooze missed by more than this while the bot was down is dropped instead of ringing late
+MAX_LATE_SECONDS = 15 * 60
+
+
+class SnoozeScheduler:
+    """
+    Schedule snoozed alarms on the bot job queue, and keep them across restarts
+    """
+
+    def __init__(self, job_queue, fire, path=SNOOZE_PATH):
+        """
+        :param job_queue: A telegram.ext.JobQueue
+        :param fire: callable(sound path, alarm id) that rings the alarm
+        :param path: File pending snoozes are kept in
+        """
+        self.job_queue = job_queue
+        self.fire = fire
+        self.path = path
+        self.lock = threading.Lock()
+        self.snoozes = []
+        ensure_dir(os.path.dirname(path))
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    snoozes = json.load(f)
+                if not isinstance(snoozes, list):
+                    raise ValueError("not a list")
+                self.snoozes = [snooze for snooze in snoozes if valid_snooze(snooze)]
+                if len(self.snoozes) < len(snoozes):
+                    print("Dropping " + str(len(snoozes) - len(self.snoozes)) + " damaged snoozes kept in " + path)
+            except (ValueError, TypeError, KeyError) as e:
+                print("Ignoring snoozes kept in " + path + ", the file is damaged: " + str(e))
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snoozes, f)
+        os.replace(temp_path, self.path)
+        return
+
+    def start(self):
+        """
+        Schedule the snoozes kept from before a restart
+        """
+        now = time.time()
+        with self.lock:
+            for snooze in list(self.snoozes):
+                if now - snooze["fire_at"] > MAX_LATE_SECONDS:
+                    print("Dropping snooze of " + snooze["sound"] + ", it was due at " +
+                          time.ctime(snooze["fire_at"]))
+                    self.snoozes.remove(snooze)
+                    continue
+                self.schedule(snooze, now)
+            self.save()
+        return
+
+    def schedule(self, snooze, now):
+        self.job_queue.run_once(self.run_snooze, max(0, snooze["fire_at"] - now), context=snooze)
+        return
+
+    def snooze(self, sound, alarm_id, minutes, snoozed_by):
+        """
+        Ring an alarm again in a few minutes
+
+        :param sound: Path of the sound to play
+        :param alarm_id: Id of the alarm, recorded in the history, None for a test alarm
+        :param minutes: Minutes to snooze, at least 1
+        :param snoozed_by: Name of who snoozed
+        :return: Timestamp the alarm rings again
+        """
+        if minutes < 1:
+            raise ValueError("Snooze for at least a minute, not " + str(minutes))
+        now = time.time()
+        # alarm.py measures latency from the start of the minute, like for alarms started by cron.
+        # Rounded up, so the alarm never rings before the snooze is over
+        fire_at = math.ceil((now + minutes * 60) / 60.0) * 60
+        snooze = {"sound": sound, "alarm": alarm_id, "fire_at": fire_at, "snoozed_by": snoozed_by}
+        with self.lock:
+            self.snoozes.append(snooze)
+            self.save()
+            self.schedule(snooze, now)
+        return fire_at
+
+    def run_snooze(self, bot, job):
+        snooze = job.context
+        with self.lock:
+            if snooze in self.snoozes:
+                self.snoozes.remove(snooze)
+                self.save()
+        self.fire(snooze["sound"], snooze["alarm"])
+        return
@@ -0,0 +1,247 @@
+"""
+A content addressed library of alarm sounds uploaded by users
+
+Uploads are transcoded once in a small worker pool to normalized PCM wav files,
+so the alarm player only has to mmap them when an alarm fires.
+Identical uploads are stored once and shared between users.
+"""
+import os
+import hashlib
+import tempfile
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func
+from database import AlarmSound
+from common import SOUNDS_DIR
+
+# Format all library sounds are transcoded to, matches the streaming player output
+FRAME_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+
+DEFAULT_SETTINGS = {
+    "workers": "1",
+    "max_per_user": "10",
+    "max_mb_per_user": "50",
+    "max_upload_mb": "20",
+    "max_seconds": "600",
+}
+
+MB = 1024 * 1024
+
+
+class SoundLibraryError(Exception):
+    def __init__(self, message=""):
+        self.message = message
+
+
+def file_digest(path):
+    """
+    Get the sha256 of a file without reading it all in to memory
+
+    :param path: Path to file
+    :return: hex digest string
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def transcode(source_path, target_path, max_seconds):
+    """
+    Decode, normalize and write a sound as PCM wav in the library format
+
+    :param source_path: Uploaded file, any format ffmpeg can read
+    :param target_path: Where to write the wav file
+    :param max_seconds: Longer sounds are cut to this length
+    """
+    # Imported here so the bot does not pay for pydub until the first upload
+    from pydub import AudioSegment
+    from pydub.effects import normalize
+
+    # ffmpeg stops after max_seconds, so a long upload is never decoded in to memory whole
+    sound = AudioSegment.from_file(source_path, parameters=["-t", str(max_seconds)])
+    sound = sound[:max_seconds * 1000]
+    sound = sound.set_frame_rate(FRAME_RATE).set_channels(CHANNELS).set_sample_width(SAMPLE_WIDTH)
+    sound = normalize(sound)
+
+    # Uploads of the same content transcode to the same target, each writes its own temp file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        sound.export(temp_path, format="wav")
+        os.replace(temp_path, target_path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+    return
+
+
+class SoundLibrary:
+    def __init__(self, engine, settings, sounds_dir=SOUNDS_DIR):
+        self.engine = engine
+        self.sounds_dir = sounds_dir
+        self.settings = DEFAULT_SETTINGS.copy()
+        self.settings.update(settings.get("sounds", {}))
+
+        os.makedirs(self.sounds_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=int(self.settings["workers"]))
+
+    def apply_settings(self, settings):
+        """
+        Apply a changed [sounds] config section, uploads already transcoding finish on the old pool
+        """
+        workers = self.settings["workers"]
+        new_settings = DEFAULT_SETTINGS.copy()
+        new_settings.update(settings.get("sounds", {}))
+        self.settings = new_settings
+        if int(new_settings["workers"]) != int(workers):
+            old_pool = self.pool
+            self.pool = ThreadPoolExecutor(max_workers=int(new_settings["workers"]))
+            old_pool.shutdown(wait=False)
+        return
+
+    def _session(self):
+        Session = sessionmaker()
+        Session.configure(bind=self.engine)
+        return Session()
+
+    def sound_path(self, digest):
+        return os.path.join(self.sounds_dir, digest + ".wav")
+
+    def get_sounds(self, owner_id):
+        session = self._session()
+        return session.query(AlarmSound).filter(AlarmSound.owner_id == owner_id).order_by(AlarmSound.id).all()
+
+    def get_sound(self, owner_id, name):
+        session = self._session()
+        return session.query(AlarmSound).filter(AlarmSound.owner_id == owner_id,
+                                                AlarmSound.name == name).first()
+
+    def _usage(self, session, owner_id):
+        """
+        :return: (number of sounds, bytes used) of a user
+        """
+        return session.query(func.count(AlarmSound.id), func.coalesce(func.sum(AlarmSound.size), 0))\
+            .filter(AlarmSound.owner_id == owner_id).one()
+
+    def check_upload(self, owner_id, size):
+        """
+        Check an upload against the quotas before downloading it
+
+        :param owner_id: telegram id of the uploading user
+        :param size: Size in bytes of the upload as reported by telegram
+        :raises SoundLibraryError: if a quota would be exceeded
+        """
+        if size is not None and size > int(self.settings["max_upload_mb"]) * MB:
+            raise SoundLibraryError("Sound is too large, the limit is " + self.settings["max_upload_mb"] + "MB")
+
+        count, used = self._usage(self._session(), owner_id)
+
+        if count >= int(self.settings["max_per_user"]):
+            raise SoundLibraryError("You have too many sounds, remove one with /sounds first")
+        if used >= int(self.settings["max_mb_per_user"]) * MB:
+            raise SoundLibraryError("Your sounds use all of your " + self.settings["max_mb_per_user"] + "MB quota")
+        return
+
+    def _unique_name(self, session, owner_id, name):
+        existing = {sound.name for sound in session.query(AlarmSound).filter(AlarmSound.owner_id == owner_id)}
+        name = name[:56]
+        new_name = name
+        i = 2
+        while new_name in existing:
+            new_name = name + " (" + str(i) + ")"
+            i += 1
+        return new_name
+
+    def add(self, owner_id, name, download):
+        """
+        Download, transcode and store a sound. Blocking, runs in the worker pool.
+
+        :param owner_id: telegram id of the uploading user
+        :param name: Name the user will pick the sound by
+        :param download: callable that writes the upload to the path it gets
+        :return: The new AlarmSound
+        :raises SoundLibraryError: if the transcoded sound does not fit in the quota of the user
+        """
+        fd, upload_path = tempfile.mkstemp(dir=self.sounds_dir, suffix=".upload")
+        os.close(fd)
+        try:
+            download(upload_path)
+            digest = file_digest(upload_path)
+            target_path = self.sound_path(digest)
+
+            # Same content was uploaded before, skip transcoding it again
+            transcoded = not os.path.isfile(target_path)
+            if transcoded:
+                transcode(upload_path, target_path, int(self.settings["max_seconds"]))
+        finally:
+            os.unlink(upload_path)
+
+        # The wav is usually much larger than the upload, check what is actually stored
+        size = os.path.getsize(target_path)
+        session = self._session()
+        _, used = self._usage(session, owner_id)
+        if used + size > int(self.settings["max_mb_per_user"]) * MB:
+            # Unless another upload of the same content was stored meanwhile
+            if transcoded and session.query(AlarmSound).filter(AlarmSound.digest == digest).count() == 0:
+                os.unlink(target_path)
+            raise SoundLibraryError("Sound takes " + str(size // MB) + "MB, it does not fit in your " +
+                                    self.settings["max_mb_per_user"] + "MB quota")
+        entry = AlarmSound(owner_id=owner_id, name=self._unique_name(session, owner_id, name),
+                           digest=digest, size=size)
+        session.add(entry)
+        session.commit()
+        session.refresh(entry)
+        session.expunge(entry)
+        return entry
+
+    def add_async(self, owner_id, name, download, callback):
+        """
+        Queue a sound to be added in the worker pool
+
+        :param callback: Called with (sound, error) when done, one of them is None
+        """
+        def task():
+            try:
+                sound = self.add(owner_id, name, download)
+            except SoundLibraryError as e:
+                callback(None, e)
+                return
+            except Exception as e:
+                print(str(traceback.format_exc()))
+                callback(None, e)
+                return
+            callback(sound, None)
+
+        self.pool.submit(task)
+        return
+
+    def remove(self, owner_id, sound_id, used_paths=()):
+        """
+        Remove a sound of a user, the file is deleted when no other user has it
+
+        :param used_paths: Sound files alarms play, a sound whose file would be deleted under an alarm is kept
+        :return: The removed AlarmSound or None if it does not exist
+        :raises SoundLibraryError: if an alarm still plays the sound
+        """
+        session = self._session()
+        sound = session.query(AlarmSound).filter(AlarmSound.owner_id == owner_id,
+                                                 AlarmSound.id == sound_id).first()
+        if sound is None:
+            return None
+        shared = session.query(AlarmSound).filter(AlarmSound.digest == sound.digest).count() > 1
+        if not shared and self.sound_path(sound.digest) in used_paths:
+            raise SoundLibraryError('An alarm plays "' + sound.name + '", remove the alarm first')
+        session.delete(sound)
+        session.commit()
+
+        if session.query(AlarmSound).filter(AlarmSound.digest == sound.digest).count() == 0:
+            try:
+                os.unlink(self.sound_path(sound.digest))
+            except FileNotFoundError:
+                pass
+        return sound
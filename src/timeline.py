@@ -0,0 +1,109 @@
+"""
+A precomputed timeline of upcoming alarm fire instants
+
+Built once for the whole horizon and reused until alarms change, so polling it only
+has to skip the instants that already passed.
+"""
+import time
+import heapq
+import bisect
+import threading
+import events
+from timezones import iter_fire_times, get_timezone
+from cron_jobs import get_job_id, get_job_info, get_local_expression, short_description
+
+DAY = 24 * 60 * 60
+
+DEFAULT_DAYS = 7
+MAX_DAYS = 31
+
+# Upper bound on instants in the timeline, an alarm every minute would otherwise flood it
+MAX_ENTRIES = 10000
+
+
+class Timeline:
+    def __init__(self, crontab, max_days=MAX_DAYS):
+        """
+        :param crontab: The CronJobs to build the timeline from
+        :param max_days: How many days ahead the timeline covers
+        """
+        self.crontab = crontab
+        self.max_days = max_days
+        self.times = []
+        self.entries = []
+        self.horizon = 0
+        self.built_until = 0
+        self.revision = 0
+        self.valid = False
+        self.lock = threading.Lock()
+        events.subscribe(self.on_event)
+
+    def on_event(self, kind, data, version):
+        if kind == events.ALARMS_CHANGED and data.get("cron_id") == self.crontab.cron_id:
+            self.invalidate()
+        return
+
+    def invalidate(self):
+        # Without the lock, the crontab publishes changes while it holds its own lock, that build takes
+        self.valid = False
+        return
+
+    def job_entries(self, job, now):
+        info = get_job_info(job)
+        alarm = {"alarm": get_job_id(job), "description": short_description(job),
+                 "owner": info.get("owner"), "timezone": info.get("tz")}
+        for fire_time in iter_fire_times(get_local_expression(job), get_timezone(info.get("tz")), now):
+            entry = {"time": fire_time}
+            entry.update(alarm)
+            yield entry
+
+    def build(self, now):
+        # Set first, so a change published while building makes the next call build again
+        self.valid = True
+        horizon = now + self.max_days * DAY
+        entries = []
+        # Merge the alarms in time order, so MAX_ENTRIES cuts off the latest instants and not whole alarms
+        merged = heapq.merge(*[self.job_entries(job, now) for job in self.crontab.job_list() if job.enabled],
+                             key=lambda entry: entry["time"])
+        for entry in merged:
+            if entry["time"] > horizon:
+                break
+            if len(entries) >= MAX_ENTRIES:
+                # The timeline only covers up to its last instant
+                horizon = entries[-1]["time"]
+                break
+            entries.append(entry)
+
+        self.entries = entries
+        self.times = [entry["time"] for entry in entries]
+        self.horizon = horizon
+        self.built_until = now + self.max_days * DAY
+        self.revision += 1
+        return
+
+    def upcoming(self, days=DEFAULT_DAYS, limit=None, now=None):
+        """
+        Get the upcoming fire instants of all enabled alarms
+
+        :param days: How many days ahead, at most max_days
+        :param limit: Max number of instants to return
+        :param now: timestamp to get instants after
+        :return: (a list of dicts with time, alarm, description, owner and timezone, a key that changes with the result)
+        """
+        if now is None:
+            now = time.time()
+        days = min(days, self.max_days)
+        end = now + days * DAY
+
+        # Notices alarms changed by other processes
+        self.crontab.refresh()
+        with self.lock:
+            # Rebuild when alarms changed or the requested window runs past the built horizon
+            if not self.valid or end > self.built_until + DAY:
+                self.build(now)
+            first = bisect.bisect_right(self.times, now)
+            last = bisect.bisect_right(self.times, min(end, self.horizon))
+            if limit is not None:
+                last = min(last, first + limit)
+            key = (self.revision, first, last)
+            return self.entries[first:last], key
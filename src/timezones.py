@@ -0,0 +1,229 @@
+"""
+Timezone helpers for alarms that ring in their owner's timezone
+
+Alarms are written to crontab in the device timezone, and keep the owner's local
+time next to them. The UTC fire instants of every alarm are cached until the
+next DST transition of the zone involved, so pytz is only consulted again when
+an offset actually changes or the alarm itself changes.
+"""
+import time
+import threading
+from datetime import datetime
+import pytz
+from dateutil.tz import tzlocal
+from croniter import croniter
+
+DAY = 24 * 60 * 60
+
+# How far ahead to look for DST transitions
+TRANSITION_HORIZON_DAYS = 400
+
+# Number of upcoming fire instants cached for every alarm
+FIRE_TIMES_COUNT = 10
+
+SYSTEM_ZONE = "system"
+
+
+def system_offset(timestamp):
+    return time.localtime(timestamp).tm_gmtoff
+
+
+def zone_offset(tz):
+    def offset(timestamp):
+        return datetime.fromtimestamp(timestamp, tz).utcoffset()
+    return offset
+
+
+def next_offset_change(offset, start, horizon_days=TRANSITION_HORIZON_DAYS):
+    """
+    Find the next time the UTC offset changes
+
+    :param offset: callable that gets a timestamp and returns the UTC offset at it
+    :param start: timestamp to search from
+    :param horizon_days: how many days ahead to search
+    :return: A timestamp within a minute after the change, or None if there is none in the horizon
+    """
+    base = offset(start)
+    low = start
+    for day in range(1, horizon_days + 1):
+        high = start + day * DAY
+        if offset(high) != base:
+            break
+        low = high
+    else:
+        return None
+
+    while high - low > 60:
+        middle = (low + high) / 2
+        if offset(middle) == base:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+DAY_NAMES = ["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"]
+
+
+def parse_dow(dow):
+    if dow.upper() in DAY_NAMES:
+        return DAY_NAMES.index(dow.upper())
+    return int(dow)
+
+
+def parse_dows(dows):
+    """
+    Parse a cron day of week field, only numbers, day names, ranges and * are supported
+
+    :param dows: A string like "*", "0-4", "SUN-THU" or "1,3,5"
+    :return: A sorted list of day numbers, or None for every day
+    """
+    if dows == "*":
+        return None
+    return_value = set()
+    for part in dows.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            return_value.update(range(parse_dow(first), parse_dow(last) + 1))
+        else:
+            return_value.add(parse_dow(part))
+    return sorted(set(day % 7 for day in return_value))
+
+
+def format_dows(dows):
+    if dows is None:
+        return "*"
+    return ",".join(str(day) for day in dows)
+
+
+def system_schedule(tz, minute, hour, dows, now=None):
+    """
+    Convert a local time in a timezone to the device timezone
+
+    :param tz: pytz timezone of the alarm owner
+    :param minute: minute in the owner timezone
+    :param hour: hour in the owner timezone
+    :param dows: list of days of week in the owner timezone, or None for every day
+    :param now: timestamp the conversion should be valid at
+    :return: (minute, hour, dows) in the device timezone
+    """
+    if now is None:
+        now = time.time()
+    today = datetime.fromtimestamp(now, tz).date()
+    local = tz.localize(datetime(today.year, today.month, today.day, hour, minute))
+    system = datetime.fromtimestamp(local.timestamp())
+
+    day_shift = (system.date() - today).days
+    if dows is not None:
+        dows = sorted((day + day_shift) % 7 for day in dows)
+    return system.minute, system.hour, dows
+
+
+def iter_fire_times(expression, tz, start):
+    """
+    Iterate over the UTC fire instants of a cron expression
+
+    :param expression: cron expression
+    :param tz: pytz timezone the expression is in, None for the device timezone
+    :param start: timestamp to start after
+    :return: generator of timestamps
+    """
+    if tz is None:
+        # croniter takes a naive start as UTC, the device zone has to be given explicitly
+        tz = tzlocal()
+    iterator = croniter(expression, datetime.fromtimestamp(start, tz))
+    while True:
+        yield iterator.get_next(datetime).timestamp()
+
+
+def get_timezone(name):
+    if name is None:
+        return None
+    return pytz.timezone(name)
+
+
+class FireTimes:
+    def __init__(self, key, times, valid_until):
+        self.key = key
+        self.times = times
+        self.valid_until = valid_until
+
+
+class FireTimeTable:
+    """
+    Cache of the next UTC fire instants of alarms
+    """
+
+    def __init__(self, count=FIRE_TIMES_COUNT):
+        self.count = count
+        self.entries = {}
+        self.transitions = {}
+        self.lock = threading.Lock()
+
+    def next_transition(self, tz, now):
+        """
+        Get the next offset change of a zone, cached until it passes
+
+        :param tz: a pytz timezone, or None for the device timezone
+        :return: timestamp of the change, infinity if there is none soon
+        """
+        name = SYSTEM_ZONE if tz is None else tz.zone
+        transition = self.transitions.get(name)
+        if transition is None or now >= transition:
+            offset = system_offset if tz is None else zone_offset(tz)
+            transition = next_offset_change(offset, now)
+            if transition is None:
+                transition = float("inf")
+            self.transitions[name] = transition
+        return transition
+
+    def compute(self, expression, tz, now, count):
+        fire_times = iter_fire_times(expression, tz, now)
+        return [next(fire_times) for _ in range(count)]
+
+    def get(self, job_id, expression, tz_name, now=None):
+        """
+        Get the next fire instants of an alarm
+
+        :param job_id: Unique id of the alarm
+        :param expression: cron expression of the alarm in its own timezone
+        :param tz_name: timezone name of the alarm, None for the device timezone
+        :param now: timestamp to get fire times after
+        :return: A list of upcoming UTC timestamps
+        """
+        if now is None:
+            now = time.time()
+        key = (expression, tz_name)
+
+        with self.lock:
+            entry = self.entries.get(job_id)
+            if entry is None or entry.key != key or now >= entry.valid_until:
+                tz = get_timezone(tz_name)
+                entry = FireTimes(key, self.compute(expression, tz, now, self.count), self.next_transition(tz, now))
+                self.entries[job_id] = entry
+
+            times = [fire_time for fire_time in entry.times if fire_time > now]
+            if len(times) == 0:
+                # Used up all cached instants, continue from the last one
+                tz = get_timezone(tz_name)
+                times = self.compute(expression, tz, max(now, entry.times[-1]), self.count)
+            entry.times = times
+            return list(times)
+
+    def invalidate(self, job_id=None):
+        with self.lock:
+            if job_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(job_id, None)
+        return
+
+    def retain(self, job_ids):
+        """
+        Drop cached entries of alarms that no longer exist
+        """
+        with self.lock:
+            for job_id in list(self.entries.keys()):
+                if job_id not in job_ids:
+                    self.entries.pop(job_id)
+        return
@@ -0,0 +1,190 @@
+"""
+Warm up the sound file, the player code and the audio device shortly before an alarm fires
+
+The alarm itself runs in a new process started by cron, so this can not hand it open objects.
+What it can do is make sure everything that process touches is already in the page cache
+and that the audio device is awake, so the time to first sound stays flat.
+"""
+import os
+import sys
+import mmap
+import time
+import shutil
+import threading
+import traceback
+import subprocess
+import importlib.util
+
+ALARM_MODULE = os.path.abspath(os.path.join(os.path.dirname(__file__), "alarm.py"))
+
+# Modules alarm.py imports to play a sound, pyaudio used to keep portaudio in a top level module
+PLAYBACK_MODULES = ["pyaudio", "_portaudio", "pydub"]
+
+DECODERS = ["ffmpeg", "avconv"]
+
+DEFAULT_LEAD_SECONDS = 30
+
+# Imports the playback modules and opens the device in a separate process,
+# so the bot does not keep them resident. Writes 50ms of 16 bit stereo silence.
+OPEN_AUDIO_DEVICE_SCRIPT = """
+import pyaudio
+import pydub
+player = pyaudio.PyAudio()
+try:
+    stream = player.open(format=player.get_format_from_width(2), channels=2, rate=44100, output=True)
+    stream.write(b"\\0" * (44100 // 20 * 4))
+    stream.close()
+finally:
+    player.terminate()
+"""
+
+OPEN_AUDIO_DEVICE_TIMEOUT = 10
+
+
+def prefetch_file(path):
+    """
+    Ask the kernel to read a file in to the page cache
+
+    :param path: Path to file
+    :return: True if the file was prefetched
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return True
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, size, os.POSIX_FADV_WILLNEED)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(data, "madvise"):
+                    data.madvise(mmap.MADV_WILLNEED)
+                # Touch a byte of every page so the read ahead is done before the alarm
+                for offset in range(0, size, mmap.PAGESIZE):
+                    data[offset]
+        return True
+    except OSError:
+        return False
+
+
+def module_files(module_names):
+    """
+    Get the source, bytecode and shared library files of top level modules without importing them
+
+    :param module_names: A list of module names
+    :return: A list of paths
+    """
+    return_value = []
+    for name in module_names:
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            continue
+
+        if spec.submodule_search_locations:
+            for location in spec.submodule_search_locations:
+                for root, _, files in os.walk(location):
+                    return_value += [os.path.join(root, file_name) for file_name in files]
+            continue
+
+        if spec.origin is not None and os.path.isfile(spec.origin):
+            return_value.append(spec.origin)
+        if spec.cached is not None:
+            return_value.append(spec.cached)
+    return return_value
+
+
+def decoder_binary():
+    for decoder in DECODERS:
+        path = shutil.which(decoder)
+        if path is not None:
+            return path
+    return None
+
+
+def open_audio_device():
+    """
+    Import the playback modules and open the default output device in a child process,
+    wakes up devices and sound servers that suspend
+    """
+    subprocess.run([sys.executable, "-c", OPEN_AUDIO_DEVICE_SCRIPT], stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, timeout=OPEN_AUDIO_DEVICE_TIMEOUT)
+    return
+
+
+def warmup(sound_path):
+    """
+    Prefetch everything an alarm needs to play sound_path
+
+    :param sound_path: The sound the alarm will play
+    :return: Seconds it took
+    """
+    start = time.time()
+    paths = [sound_path, ALARM_MODULE] + module_files(PLAYBACK_MODULES)
+
+    decoder = decoder_binary()
+    if decoder is not None:
+        paths.append(decoder)
+
+    for path in paths:
+        prefetch_file(path)
+
+    try:
+        open_audio_device()
+    except Exception:
+        print(str(traceback.format_exc()))
+
+    return time.time() - start
+
+
+class WarmupScheduler:
+    """
+    Schedule a warmup a little before each upcoming alarm on the bot job queue
+    """
+
+    def __init__(self, crontab, job_queue, get_sound, lead_seconds=DEFAULT_LEAD_SECONDS, check_interval=60):
+        """
+        :param crontab: The CronJobs holding the alarms
+        :param job_queue: A telegram.ext.JobQueue
+        :param get_sound: callable returning the sound path of a cron job
+        :param lead_seconds: How long before an alarm to warm up
+        :param check_interval: How often to look for upcoming alarms
+        """
+        self.crontab = crontab
+        self.job_queue = job_queue
+        self.get_sound = get_sound
+        self.lead_seconds = lead_seconds
+        self.check_interval = check_interval
+        self.scheduled = set()
+
+    def start(self):
+        self.job_queue.run_repeating(self.check, interval=self.check_interval, first=0)
+        return
+
+    def check(self, bot, job):
+        """
+        Job queue callback, schedule warmups for alarms firing before the next check
+        """
+        now = time.time()
+        horizon = now + self.lead_seconds + self.check_interval
+
+        for cron_job, fire_time in self.crontab.job_fire_times():
+            if fire_time > horizon:
+                break
+            if not cron_job.enabled:
+                continue
+            sound_path = self.get_sound(cron_job)
+            key = (sound_path, fire_time)
+            if key in self.scheduled:
+                continue
+            self.scheduled.add(key)
+            self.job_queue.run_once(self.run_warmup, max(0, fire_time - self.lead_seconds - now),
+                                    context=sound_path)
+
+        self.scheduled = {key for key in self.scheduled if key[1] >= now}
+        return
+
+    def run_warmup(self, bot, job):
+        # Keep the job queue free while the disk and audio device are busy
+        thread = threading.Thread(target=warmup, args=(job.context,))
+        thread.daemon = True
+        thread.start()
+        return
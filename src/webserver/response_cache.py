@@ -0,0 +1,224 @@
+"""
+Response caching for the webserver
+
+Static files are read and compressed once at startup and served with fingerprinted urls,
+rendered pages get an ETag from the data version so unchanged pages are answered with 304.
+Pages have no Last-Modified, the data version can change several times within its one second resolution.
+Every encoding of a response has its own ETag, a cache never gets a gzip body for a request without gzip.
+Compressed bodies are kept in a bounded in-memory cache.
+"""
+import os
+import gzip
+import hashlib
+import mimetypes
+import threading
+import functools
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import formatdate
+from flask import request, Response, make_response
+import events
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cache-Control for urls that have the file fingerprint in them
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Cache-Control for everything that must be checked with the server first
+REVALIDATE = "no-cache"
+
+GZIP_LEVEL = 6
+
+# Part of the ETags of data that is only kept by this process
+BOOT_ID = os.urandom(8).hex()
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def encoding_etag(tag, encoding):
+    """
+    :param tag: ETag value without quotes
+    :param encoding: "br", "gzip" or None
+    :return: The quoted ETag of the body in that encoding
+    """
+    return '"' + tag + "-" + (encoding or "identity") + '"'
+
+
+def accepted_encoding():
+    """
+    Get the best encoding the client accepts
+
+    :return: "br", "gzip" or None
+    """
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    if brotli is not None and "br" in accept_encoding:
+        return "br"
+    if "gzip" in accept_encoding:
+        return "gzip"
+    return None
+
+
+class ResponseCache:
+    """
+    A least recently used cache of (body, mimetype) bounded by the total size of the bodies
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value[0])
+            self.entries[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        return
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+        return
+
+
+class StaticAsset:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.fingerprint = hashlib.sha1(self.data).hexdigest()[:12]
+        modified_at = int(os.path.getmtime(path))
+        self.last_modified = formatdate(modified_at, usegmt=True)
+        self.modified_at = datetime.fromtimestamp(modified_at, timezone.utc)
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = {"gzip": compress(self.data, "gzip")}
+        if brotli is not None:
+            self.variants["br"] = compress(self.data, "br")
+
+
+class StaticAssets:
+    """
+    Files of a static folder with their compressed variants, built once at startup
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.assets = {}
+        for root, _, files in os.walk(folder):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                self.assets[os.path.relpath(path, folder).replace(os.sep, "/")] = StaticAsset(path)
+
+    def fingerprint(self, filename):
+        asset = self.assets.get(filename)
+        if asset is None:
+            return None
+        return asset.fingerprint
+
+    def response(self, filename):
+        """
+        Serve a static file, with a long lived cache if requested by its fingerprinted url
+        """
+        asset = self.assets.get(filename)
+        if asset is None:
+            return Response(status=404)
+
+        cache_control = IMMUTABLE if request.args.get("v") == asset.fingerprint else REVALIDATE
+        encoding = accepted_encoding()
+        etag = encoding_etag(asset.fingerprint, encoding)
+        # If-None-Match wins when a client sends both
+        if "If-None-Match" in request.headers:
+            not_modified = etag in request.headers["If-None-Match"]
+        else:
+            not_modified = request.if_modified_since is not None and request.if_modified_since >= asset.modified_at
+        if not_modified:
+            response = Response(status=304)
+        else:
+            if encoding is None:
+                response = Response(asset.data, mimetype=asset.mimetype)
+            else:
+                response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+                response.headers["Content-Encoding"] = encoding
+
+        response.headers["ETag"] = etag
+        response.headers["Last-Modified"] = asset.last_modified
+        response.headers["Cache-Control"] = cache_control
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+def page_etag(user_id, encoding):
+    key = "/".join([request.endpoint, request.query_string.decode("utf-8"), str(user_id), str(events.version())])
+    return encoding_etag(hashlib.sha1(key.encode("utf-8")).hexdigest(), encoding)
+
+
+def cached_page(cache, get_user_id):
+    """
+    Decorator for views that only depend on the data version, the query string and the user.
+    Answers with 304 when the client has the current version, and caches the compressed body.
+
+    :param cache: a ResponseCache
+    :param get_user_id: callable returning the id of the logged in user
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def view_func(*args, **kwargs):
+            encoding = accepted_encoding()
+            etag = page_etag(get_user_id(), encoding)
+            if etag in request.headers.get("If-None-Match", ""):
+                response = Response(status=304)
+            else:
+                cached = cache.get(etag)
+                if cached is None:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    body = response.get_data()
+                    if encoding is not None:
+                        body = compress(body, encoding)
+                    cached = (body, response.mimetype)
+                    cache.put(etag, *cached)
+
+                body, mimetype = cached
+                response = Response(body, mimetype=mimetype)
+                if encoding is not None:
+                    response.headers["Content-Encoding"] = encoding
+
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = "private, " + REVALIDATE
+            response.headers["Vary"] = "Accept-Encoding, Cookie"
+            return response
+
+        return view_func
+
+    return decorator
@@ -3,28 +3,56 @@ Webserver to handle users requsting telegeam access
 """
 import os
 import sys
-from io import BytesIO
+import hashlib
 from wtforms import StringField, PasswordField, BooleanField
 from wtforms.validators import InputRequired, Length
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, after_this_request, request, Response, redirect, url_for, abort
-from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user
+from flask import Flask, render_template, after_this_request, request, Response, redirect, url_for, abort, \
+    stream_with_context
+from sqlalchemy.exc import SQLAlchemyError
+from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user, current_user
 from flask_bootstrap import Bootstrap
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from flask_wtf import FlaskForm
-import gzip
 import json
 import functools
+import threading
+from collections import OrderedDict
 from sqlalchemy.ext.declarative import declarative_base
-from database import TelegramUser
+from database import TelegramUser, AlarmEvent, ROLES, create_tables
+from datetime import datetime
 
 
 SECRET_LENGTH = 24
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from common import get_config, get_uri
+from common import get_config, get_uri, on_config_change, restart_needed
+import memory
+import events
+from webserver.response_cache import ResponseCache, StaticAssets, cached_page, compress, BOOT_ID, REVALIDATE
+from cron_jobs import get_cron_jobs
+from timeline import Timeline, DEFAULT_DAYS
+from alarm_sets import export_alarms, import_alarms, AlarmSetError
+from alarm_watcher import get_alarm_watcher
+
+
+DEFAULT_CACHE_MB = 4
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Seconds between comments on an idle event stream, to notice closed tabs and keep proxies from timing out
+HEARTBEAT_SECONDS = 15
+
+# Every open event stream holds a server thread
+DEFAULT_MAX_EVENT_STREAMS = 20
+
+# Events sent to the admin pages, ALARMS_CHANGED has nothing the pages show
+STREAMED_EVENTS = [events.USER_JOINED, events.ROLE_CHANGED, events.ALARM_FIRED, events.ALARM_STOPPED]
+
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), "static")
 
 
 debug = 'DEBUG' in os.environ and os.environ['DEBUG'] == "on"
@@ -44,13 +72,15 @@ def gzipped(f):
 
             if response.status_code < 200 or response.status_code >= 300 or 'Content-Encoding' in response.headers:
                 return response
-            gzip_buffer = BytesIO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(response.data)
-            gzip_file.close()
 
-            response.data = gzip_buffer.getvalue()
+            # Same body was compressed before, reuse it
+            key = ("gzipped", hashlib.sha1(response.data).digest())
+            cached = response_cache.get(key)
+            if cached is None:
+                cached = (compress(response.data, "gzip"), response.mimetype)
+                response_cache.put(key, *cached)
+
+            response.data = cached[0]
             response.headers['Content-Encoding'] = 'gzip'
             response.headers['Vary'] = 'Accept-Encoding'
             response.headers['Content-Length'] = len(response.data)
@@ -62,7 +92,33 @@ def gzipped(f):
     return view_func
 
 
-app = Flask("Telegram bot settings", template_folder=os.path.join(os.path.dirname(__file__), "templates"))
+app = Flask("Telegram bot settings", template_folder=os.path.join(os.path.dirname(__file__), "templates"),
+            static_folder=STATIC_FOLDER)
+
+response_cache = ResponseCache(get_config().get_int("webserver", "cache_mb", DEFAULT_CACHE_MB) * 1024 * 1024)
+on_config_change("webserver", ["cache_mb"],
+                 lambda config: response_cache.resize(config.get_int("webserver", "cache_mb", DEFAULT_CACHE_MB) * 1024 * 1024))
+on_config_change("webserver", ["max_event_streams"])
+static_assets = StaticAssets(STATIC_FOLDER)
+
+
+def static(filename):
+    return static_assets.response(filename)
+
+
+# Serve static files from memory with their precompressed variants
+app.view_functions["static"] = static
+
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    """
+    Add the file fingerprint to static urls, so they can be cached forever
+    """
+    if endpoint == "static" and "filename" in values:
+        fingerprint = static_assets.fingerprint(values["filename"])
+        if fingerprint is not None:
+            values["v"] = fingerprint
 
 
 def set_app_db(a):
@@ -125,7 +181,7 @@ def init_db(uri):
     engine = create_engine(uri)
     User.metadata.create_all(engine)
     AppConfig.metadata.create_all(engine)
-    TelegramUser.metadata.create_all(engine)
+    create_tables(engine)
 
     # Add admin if does not exist
 
@@ -151,6 +207,7 @@ def init_db(uri):
         app_config = session.query(AppConfig).first()
 
     app.config["SECRET_KEY"] = app_config.secret
+    session.close()
     return
 
 
@@ -162,18 +219,60 @@ class LoginForm(FlaskForm):
 
 @app.route("/")
 @login_required
+@cached_page(response_cache, lambda: current_user.get_id())
 def root():
-    return render_template("index.jinja2", users=get_telegram_user_list(), row=5)
+    return render_template("index.jinja2", roles=ROLES, page_size=DEFAULT_PAGE_SIZE)
+
+
+@app.route("/api/users")
+@login_required
+@cached_page(response_cache, lambda: current_user.get_id())
+def users_page():
+    """
+    A page of telegram users in id order
+
+    Query arguments: after - id of the last user of the previous page, limit - page size,
+    role - only users with this role, q - only users whose name starts with this
+    """
+    after = request.args.get("after", None, type=int)
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    users = get_telegram_user_page(after, limit, request.args.get("role"), request.args.get("q"))
+
+    next_after = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_after = users[-1].id
+
+    return Response(json.dumps({"users": [{"id": user.id, "name": user.name, "role": user.role} for user in users],
+                                "next": next_after}), mimetype="application/json")
 
 
 @app.route("/update_role", methods=['POST'])
 @login_required
 def update_role():
     content = request.json
-    user_id = content["user"]
-    role = content["role"]
-    update_user_role(user_id, role)
-    return json.dumps({'success': True})
+    if not isinstance(content, dict):
+        abort(400)
+    result = update_user_roles([{"user": content.get("user"), "role": content.get("role")}])[0]
+    return json.dumps(result)
+
+
+@app.route("/api/users/roles", methods=['POST'])
+@login_required
+def update_roles():
+    """
+    Update the roles of many users in one transaction
+
+    Takes a json list of {"user": id, "role": role} and returns the result of each change
+    """
+    changes = request.json
+    if not isinstance(changes, list):
+        abort(400)
+    errors = [{"index": i, "error": "Change must be an object"} for i, change in enumerate(changes)
+              if not isinstance(change, dict)]
+    if len(errors) > 0:
+        return Response(json.dumps({"errors": errors}), status=400, mimetype="application/json")
+    return Response(json.dumps({"results": update_user_roles(changes)}), mimetype="application/json")
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -191,6 +290,197 @@ def login():
     return render_template('login.jinja2', form=form)
 
 
+@app.route("/admin/memory")
+@login_required
+def memory_report():
+    limit = request.args.get("limit", 10, type=int)
+    return Response(json.dumps(memory.report(limit)), mimetype="application/json")
+
+
+@app.route("/admin/config")
+@login_required
+def config_report():
+    """
+    Settings changed in the config file that need a restart to apply
+    """
+    return Response(json.dumps({"path": get_config().path,
+                                "restart_needed": [section + "." + key for section, key in restart_needed()]}),
+                    mimetype="application/json")
+
+
+_timeline = None
+
+
+def get_timeline():
+    global _timeline
+    if _timeline is None:
+        _timeline = Timeline(get_cron_jobs("alarmbot"))
+    return _timeline
+
+
+@app.route("/alarms")
+@login_required
+def alarms():
+    return render_template("alarms.jinja2", days=DEFAULT_DAYS)
+
+
+@app.route("/api/alarms/upcoming")
+@login_required
+def upcoming_alarms():
+    """
+    The next fire instants of all alarms
+
+    Query arguments: days - how many days ahead, limit - max number of instants
+    """
+    days = request.args.get("days", DEFAULT_DAYS, type=int)
+    limit = request.args.get("limit", None, type=int)
+    upcoming, key = get_timeline().upcoming(days, limit)
+
+    etag = '"' + "-".join([BOOT_ID] + [str(part) for part in key]) + '"'
+    if etag in request.headers.get("If-None-Match", ""):
+        response = Response(status=304)
+    else:
+        response = Response(json.dumps({"alarms": upcoming}), mimetype="application/json")
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, " + REVALIDATE
+    return response
+
+
+@app.route("/api/alarms/export")
+@login_required
+def export_alarm_set():
+    """
+    All alarms as a json file, that can be imported on this or another device
+    """
+    response = Response(json.dumps(export_alarms(get_cron_jobs("alarmbot")), indent=2), mimetype="application/json")
+    response.headers["Content-Disposition"] = "attachment; filename=alarms.json"
+    return response
+
+
+@app.route("/api/alarms/import", methods=['POST'])
+@login_required
+def import_alarm_set():
+    """
+    Make the alarms match an exported json file, with a single crontab write
+
+    The body must be sent as application/json, which a form on another site can not do without the browser asking first.
+
+    Query arguments: prune - "on" to remove alarms that are not in the file
+    """
+    prune = request.args.get("prune", "off") == "on"
+    try:
+        summary = import_alarms(get_cron_jobs("alarmbot"), request.get_json(silent=True), prune)
+    except AlarmSetError as e:
+        return Response(json.dumps({"error": e.message}), status=400, mimetype="application/json")
+    return Response(json.dumps(summary), mimetype="application/json")
+
+
+@app.route("/history")
+@login_required
+def history():
+    return render_template("history.jinja2")
+
+
+@app.route("/api/history")
+@login_required
+def history_events():
+    """
+    Alarm events in a time range, newest first
+
+    Query arguments: start, end - timestamps of the range of fired times, limit - max number of events
+    """
+    start = request.args.get("start", None, type=float)
+    end = request.args.get("end", None, type=float)
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+    query = db.session.query(AlarmEvent)
+    if start is not None:
+        query = query.filter(AlarmEvent.fired_at >= datetime.fromtimestamp(start))
+    if end is not None:
+        query = query.filter(AlarmEvent.fired_at < datetime.fromtimestamp(end))
+    alarm_events = query.order_by(AlarmEvent.fired_at.desc()).limit(limit).all()
+
+    def timestamp(value):
+        return None if value is None else value.timestamp()
+
+    return Response(json.dumps({"events": [{"alarm": alarm_event.alarm_id,
+                                            "sound": os.path.basename(alarm_event.sound or ""),
+                                            "fired_at": timestamp(alarm_event.fired_at),
+                                            "first_audio_at": timestamp(alarm_event.first_audio_at),
+                                            "stopped_at": timestamp(alarm_event.stopped_at),
+                                            "stopped_by": alarm_event.stopped_by,
+                                            "latency_ms": alarm_event.latency_ms}
+                                           for alarm_event in alarm_events]}),
+                    mimetype="application/json")
+
+
+_event_streams = 0
+_event_streams_lock = threading.Lock()
+
+
+def server_sent_event(kind, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append("id: " + str(event_id))
+    lines.append("event: " + kind)
+    lines.append("data: " + json.dumps(data))
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route("/api/events")
+@login_required
+def event_stream():
+    """
+    Server-Sent Events of users joining, role changes and alarms ringing, so admin pages update without reloading
+
+    The first event is "state" with the alarms ringing now. A "resync" event means events were dropped
+    because the page fell behind, and it should reload its data.
+    """
+    global _event_streams
+    max_streams = get_config().get_int("webserver", "max_event_streams", DEFAULT_MAX_EVENT_STREAMS)
+    with _event_streams_lock:
+        if _event_streams >= max_streams:
+            return Response(status=503, headers={"Retry-After": str(HEARTBEAT_SECONDS)})
+        _event_streams += 1
+
+    watcher = get_alarm_watcher()
+    listener = events.Listener()
+    released = []
+
+    def release():
+        # From the generator, or from closing the response when the client left before the first chunk
+        global _event_streams
+        with _event_streams_lock:
+            if len(released) > 0:
+                return
+            released.append(True)
+            _event_streams -= 1
+        listener.close()
+        return
+
+    def generate():
+        try:
+            yield "retry: 5000\n" + server_sent_event("state", {"ringing": watcher.ringing_alarms()}, events.version())
+            while True:
+                event = listener.get(HEARTBEAT_SECONDS)
+                if listener.take_overflow():
+                    yield server_sent_event("resync", {}, events.version())
+                elif event is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    event_version, kind, data = event
+                    if kind in STREAMED_EVENTS:
+                        yield server_sent_event(kind, data, event_version)
+        finally:
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.call_on_close(release)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 # somewhere to logout
 @app.route("/logout")
 @login_required
@@ -217,32 +507,91 @@ def run():
     return
 
 
-def get_telegram_user_list():
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
-    # Add admin if does not exist
-
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
+def get_telegram_user_page(after, limit, role=None, prefix=None):
+    """
+    Get a page of telegram users with keyset pagination
 
-    return session.query(TelegramUser)
+    :param after: Only users with an id larger than this, None for the first page
+    :param limit: Page size, one more user is returned if there is a next page
+    :param role: Only users with this role
+    :param prefix: Only users whose name starts with this
+    :return: A list of TelegramUser
+    """
+    query = db.session.query(TelegramUser)
+    if after is not None:
+        query = query.filter(TelegramUser.id > after)
+    if role:
+        query = query.filter(TelegramUser.role == role)
+    if prefix:
+        query = query.filter(TelegramUser.name.startswith(prefix, autoescape=True))
+    return query.order_by(TelegramUser.id).limit(limit + 1).all()
 
 
-def update_user_role(telegram_id, role):
+def update_user_roles(changes):
     """
-    Update the role of a user in the telegram database
-    :param telegram_id:
-    :param role:
-    :return:
-    :return:
+    Update the roles of users in the telegram database in a single transaction,
+    with one update per role
+
+    :param changes: A list of {"user": telegram id, "role": role}, later changes of a user win
+    :return: A list with {"user", "role", "success"} and "error" if it failed for every change
     """
-    engine = create_engine(app.config["SQLALCHEMY_DATABASE_URI"])
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    session = Session()
-    session.query(TelegramUser).filter(TelegramUser.id == telegram_id).update({"role": role})
-    session.commit()
-    return
+    results = []
+    user_roles = OrderedDict()
+    for change in changes:
+        if not isinstance(change, dict):
+            results.append({"user": None, "role": None, "success": False, "error": "Invalid change"})
+            continue
+        result = {"user": change.get("user"), "role": change.get("role"), "success": False}
+        results.append(result)
+        try:
+            user_id = int(result["user"])
+        except (TypeError, ValueError):
+            result["error"] = "Invalid user"
+            continue
+        if result["role"] not in ROLES:
+            result["error"] = "Invalid role"
+            continue
+        user_roles[user_id] = result["role"]
+
+    existing = set()
+    if len(user_roles) > 0:
+        existing = {user_id for (user_id,) in db.session.query(TelegramUser.id)
+                    .filter(TelegramUser.id.in_(list(user_roles.keys())))}
+
+    role_users = OrderedDict()
+    for user_id, role in user_roles.items():
+        if user_id in existing:
+            role_users.setdefault(role, []).append(user_id)
+
+    error = None
+    try:
+        for role, user_ids in role_users.items():
+            db.session.query(TelegramUser).filter(TelegramUser.id.in_(user_ids))\
+                .update({"role": role}, synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        error = "Database error"
+        print(str(e))
+
+    applied = []
+    for result in results:
+        if "error" in result:
+            continue
+        user_id = int(result["user"])
+        if user_id not in existing:
+            result["error"] = "No such user"
+        elif error is not None:
+            result["error"] = error
+        elif user_roles[user_id] == result["role"]:
+            result["success"] = True
+            applied.append({"user": user_id, "role": result["role"]})
+        else:
+            result["error"] = "Overridden by a later change"
+
+    if len(applied) > 0:
+        events.publish(events.ROLE_CHANGED, changes=applied)
+    return results
 
 
 if __name__ == "__main__":